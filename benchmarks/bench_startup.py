@@ -0,0 +1,77 @@
+"""
+Startup cost of the CLI: wall clock for `main.py -h` and for importing each subcommand's
+subsystem, plus the heaviest imports from `python -X importtime`
+"""
+
+import argparse
+import pathlib
+import statistics
+import subprocess
+import sys
+import time
+
+from typing import Final
+
+src: Final[str] = str(pathlib.Path(__file__).resolve().parent.parent / "src")
+
+# flag -> module main.py imports for it
+subcommands: Final[dict[str, str]] = {
+    "-h": "main",
+    "-a": "app",
+    "-s": "sync",
+    "-c": "cal",
+}
+
+
+def import_code(module: str) -> str:
+    return f"import sys; sys.path.insert(0, {src!r}); import main, {module}"
+
+
+def wall_clock(module: str, repeat: int) -> float:
+    """Median seconds for a fresh interpreter to import main and module"""
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", import_code(module)], check=True)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def importtime(module: str, top: int) -> list[tuple[int, str]]:
+    """The top cumulative import times in microseconds as (time, package)"""
+
+    stderr = subprocess.run([sys.executable, "-X", "importtime", "-c", import_code(module)], check=True, capture_output=True, text=True).stderr
+    ret = []
+    for line in stderr.splitlines()[1:]:
+        _, cumulative, name = line.removeprefix("import time:").split("|")
+        # Top level modules and what they import directly, anything deeper is included in their cumulative time
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth <= 1:
+            ret.append((int(cumulative), name.strip()))
+    return sorted(ret, reverse=True)[:top]
+
+
+def bench(repeat: int, top: int, max_ms: float | None) -> int:
+    slow = []
+    for flag, module in subcommands.items():
+        seconds = wall_clock(module, repeat)
+        print(f"{flag} ({module}): {seconds * 1000:.0f}ms")
+        for cumulative, name in importtime(module, top):
+            print(f"    {cumulative / 1000:8.1f}ms {name}")
+        if max_ms is not None and seconds * 1000 > max_ms:
+            slow.append(flag)
+
+    if slow:
+        print(f"{', '.join(slow)} took longer than {max_ms}ms")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-r", "--repeat", help="Runs per subcommand", type=int, default=5)
+    parser.add_argument("-t", "--top", help="Number of imports to show per subcommand", type=int, default=5)
+    parser.add_argument("--max-ms", help="Fail if any subcommand takes longer than this to start", type=float, default=None)
+    args = parser.parse_args()
+    sys.exit(bench(args.repeat, args.top, args.max_ms))
@@ -0,0 +1,199 @@
+"""
+Times the storage (including commit latency), sync, calendar, rebuild and export paths
+against synthetic histories (1k and 100k events by default, 1M with --sizes), saving the
+results as JSON and optionally failing if anything is slower than a baseline run
+"""
+
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import pathlib
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent / "src"))
+
+import db
+
+from typing import Any, Callable, Final
+
+default_sizes: Final[list[int]] = [1_000, 100_000]
+default_output: Final[str] = str(pathlib.Path(__file__).resolve().parent / "results" / "latest.json")
+# rows written one transaction at a time, each one waits on the disk so more would take minutes
+per_row_sample: Final[int] = 50
+# dates read one at a time with read_timer_log_date
+date_sample: Final[int] = 50
+# timings shorter than this are too noisy to fail on
+min_compare_seconds: Final[float] = 0.005
+
+
+def make_history(n: int, n_labels: int = 50, seed: int = 0) -> list[db.LogRow]:
+    """
+    n log rows for n_labels timers, several of which run at the same time, a few minutes
+    apart so that 100k rows covers about a year
+    """
+
+    rng = random.Random(seed)
+    ts = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+    running = set()
+    rows = []
+    for _ in range(n):
+        ts += datetime.timedelta(seconds=rng.randint(60, 600), microseconds=rng.randint(0, 999_999))
+        label = f"label {rng.randrange(n_labels)}"
+        state = "stop" if label in running else "start"
+        running.symmetric_difference_update({label})
+        rows.append(db.LogRow(label, state, ts.date(), ts))
+    return rows
+
+
+def timed(fn: Callable[[], Any], n: int) -> dict[str, float]:
+    """Seconds fn takes, with n the number of rows (or calls) it handles"""
+
+    start = time.perf_counter()
+    # Anything printed along the way isn't what is being measured
+    with contextlib.redirect_stdout(io.StringIO()):
+        fn()
+    seconds = time.perf_counter() - start
+    return dict(seconds=seconds, n=n, per_sec=n / seconds if seconds else 0.0)
+
+
+def commit_latency(rows: list[db.LogRow], conn_str: str) -> dict[str, float]:
+    """Writes each row in a transaction of its own, like the app does, timing each commit"""
+
+    latencies = []
+    for row in rows:
+        start = time.perf_counter()
+        db.write_log_rows([row], conn_str=conn_str)
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    seconds = sum(latencies)
+    return dict(
+        seconds=seconds,
+        n=len(rows),
+        per_sec=len(rows) / seconds if seconds else 0.0,
+        p50_ms=latencies[len(latencies) // 2] * 1000,
+        p95_ms=latencies[int(len(latencies) * 0.95)] * 1000,
+        max_ms=latencies[-1] * 1000,
+    )
+
+
+def bench_size(n: int, tmp: pathlib.Path) -> dict[str, dict[str, float]]:
+    import cal
+    import rebuild_state_from_log
+    import sync
+
+    history = make_history(n)
+    dicts = [row._asdict() for row in history]
+    names = ("local", "remote", "per_row", "dict_batch", "commit", "commit_rollback_journal")
+    local, remote, per_row, dict_batch, commit, commit_rollback_journal = [f"sqlite:///{tmp}/{name}.sqlite3" for name in names]
+    # SQLite's defaults, which sync the journal and the db to disk on every commit
+    db.set_sqlite_pragmas(commit_rollback_journal, journal_mode=None, synchronous=None)
+    for conn_str in (local, remote, per_row, dict_batch, commit, commit_rollback_journal):
+        # Creating the tables isn't part of any of the timings
+        db.get_engine_and_ddl(conn_str)
+
+    results = {}
+    sample = dicts[:per_row_sample]
+    results["write_timer_log"] = timed(lambda: [db.write_timer_log(row, conn_str=per_row) for row in sample], len(sample))
+    results["write_timer_logs"] = timed(lambda: db.write_timer_logs(dicts, conn_str=dict_batch), n)
+    results["write_log_rows"] = timed(lambda: db.write_log_rows(history, conn_str=local), n)
+    results["commit"] = commit_latency(history[:per_row_sample], commit)
+    results["commit_rollback_journal"] = commit_latency(history[:per_row_sample], commit_rollback_journal)
+
+    dates = sorted({row.date for row in history})
+    dates = dates[:: max(1, len(dates) // date_sample)]
+    results["read_timer_log_date"] = timed(lambda: [db.read_timer_log_date(date, conn_str=local) for date in dates], len(dates))
+    results["read_timer_log"] = timed(lambda: sum(map(len, db.iter_timer_log(conn_str=local))), n)
+
+    results["sync_catch_up"] = timed(lambda: sync.sync_log(local, remote), n)
+    results["sync_no_op"] = timed(lambda: sync.sync_log(local, remote), 0)
+
+    first, last = history[0].date, history[-1].date
+    cwd = os.getcwd()
+    os.chdir(tmp)
+    try:
+        results["cal"] = timed(lambda: cal.cal(first, last, conn_str=local), n)
+    finally:
+        os.chdir(cwd)
+
+    results["rebuild_full"] = timed(lambda: rebuild_state_from_log.rebuild(full=True, conn_str=local), n)
+    results["rebuild_incremental"] = timed(lambda: rebuild_state_from_log.rebuild(conn_str=local), 0)
+
+    try:
+        import export
+        import pyarrow  # noqa: F401
+    except ImportError:
+        pass
+    else:
+        results["export"] = timed(lambda: export.export(tmp / "export", full=True, conn_str=local), n)
+
+    return results
+
+
+def meta() -> dict[str, Any]:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return dict(
+        ts=datetime.datetime.now(tz=datetime.timezone.utc).isoformat(),
+        commit=commit,
+        python=platform.python_version(),
+        sqlite=sqlite3.sqlite_version,
+        platform=platform.platform(),
+    )
+
+
+def compare(results: dict[str, Any], baseline: dict[str, Any], max_regression: float) -> list[str]:
+    """Paths which took more than (1 + max_regression) times as long as in baseline"""
+
+    slower = []
+    for size, paths in results["results"].items():
+        for path, result in paths.items():
+            before = baseline["results"].get(size, {}).get(path)
+            if before is None or max(before["seconds"], result["seconds"]) < min_compare_seconds:
+                continue
+            if result["seconds"] > before["seconds"] * (1 + max_regression):
+                slower.append(f"{path} ({size} events): {before['seconds']:.3f}s -> {result['seconds']:.3f}s")
+    return slower
+
+
+def bench(sizes: list[int], output: str, baseline: str | None, max_regression: float) -> int:
+    results = dict(meta=meta(), results={})
+    for n in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            results["results"][str(n)] = paths = bench_size(n, pathlib.Path(tmp))
+        print(f"{n} events")
+        for path, result in paths.items():
+            latency = f"  p50 {result['p50_ms']:.2f}ms p95 {result['p95_ms']:.2f}ms" if "p50_ms" in result else ""
+            print(f"  {path:<24} {result['seconds']:8.3f}s  {result['per_sec']:>12,.0f}/sec{latency}")
+
+    pathlib.Path(output).parent.mkdir(parents=True, exist_ok=True)
+    pathlib.Path(output).write_text(json.dumps(results, indent=2))
+    print(f"Results written to {output}")
+
+    if baseline is None:
+        return 0
+
+    slower = compare(results, json.loads(pathlib.Path(baseline).read_text()), max_regression)
+    for line in slower:
+        print(f"Slower than {baseline}: {line}")
+    return 1 if slower else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", "--sizes", help="Comma separated numbers of events", type=lambda s: [int(n) for n in s.split(",")], default=default_sizes)
+    parser.add_argument("-o", "--output", help="Where to write the results as JSON", type=str, default=default_output)
+    parser.add_argument("--baseline", help="Results from an earlier run to compare against", type=str, default=None)
+    parser.add_argument("--max-regression", help="Fail if anything takes this much longer than the baseline (0.25 is 25%%)", type=float, default=0.25)
+    args = parser.parse_args()
+    sys.exit(bench(args.sizes, args.output, args.baseline, args.max_regression))
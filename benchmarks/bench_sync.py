@@ -0,0 +1,43 @@
+"""Catch-up sync of a local history into an empty remote, then a rerun with nothing to do"""
+
+import argparse
+import pathlib
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent / "src"))
+
+import db
+import sync
+from bench_write import make_rows
+
+
+def bench(n: int, remote_conn_str: str | None) -> None:
+    rows = make_rows(n)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        local_conn_str = f"sqlite:///{tmp}/local.sqlite3"
+        # A second SQLite file stands in for the remote unless one is given
+        remote_conn_str = remote_conn_str or f"sqlite:///{tmp}/remote.sqlite3"
+        db.write_timer_logs(rows, conn_str=local_conn_str)
+
+        start = time.perf_counter()
+        n_to_remote, _ = sync.sync_log(local_conn_str, remote_conn_str)
+        catch_up = time.perf_counter() - start
+
+        start = time.perf_counter()
+        sync.sync_log(local_conn_str, remote_conn_str)
+        rerun = time.perf_counter() - start
+
+    print(f"{n} rows")
+    print(f"  catch-up sync: {catch_up:.3f}s, {n_to_remote / catch_up:,.0f} rows/sec")
+    print(f"  rerun:         {rerun * 1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", "--rows", help="Number of rows to sync", type=int, default=100_000)
+    parser.add_argument("--remote", help="Connection string for the remote, should be an empty database", type=str, default=None)
+    args = parser.parse_args()
+    bench(args.rows, args.remote)
@@ -0,0 +1,59 @@
+"""Rows/sec for writing timer_log one row per transaction vs in a single batch, as dicts or LogRows"""
+
+import argparse
+import datetime
+import pathlib
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent / "src"))
+
+import db
+
+from typing import Any
+
+
+def make_rows(n: int) -> list[dict[str, Any]]:
+    """Alternating start/stop rows, one second apart"""
+
+    t0 = datetime.datetime(2023, 6, 24, tzinfo=datetime.timezone.utc)
+    rows = []
+    for i in range(n):
+        ts = t0 + datetime.timedelta(seconds=i)
+        rows.append(dict(label=f"label {i // 2 % 10}", state="start" if i % 2 == 0 else "stop", date=ts.date(), ts=ts))
+    return rows
+
+
+def bench(n: int) -> None:
+    rows = make_rows(n)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        per_row_url = f"sqlite:///{tmp}/per_row.sqlite3"
+        batch_url = f"sqlite:///{tmp}/batch.sqlite3"
+        log_rows_url = f"sqlite:///{tmp}/log_rows.sqlite3"
+        log_rows = [db.LogRow(**row) for row in rows]
+
+        start = time.perf_counter()
+        for row in rows:
+            db.write_timer_log(row, conn_str=per_row_url)
+        per_row = time.perf_counter() - start
+
+        start = time.perf_counter()
+        db.write_timer_logs(rows, conn_str=batch_url)
+        batch = time.perf_counter() - start
+
+        start = time.perf_counter()
+        db.write_log_rows(log_rows, conn_str=log_rows_url)
+        fast = time.perf_counter() - start
+
+    print(f"{n} rows")
+    print(f"  write_timer_log (one transaction per row): {per_row:.3f}s, {n / per_row:,.0f} rows/sec")
+    print(f"  write_timer_logs (single transaction):     {batch:.3f}s, {n / batch:,.0f} rows/sec")
+    print(f"  write_log_rows (single transaction):       {fast:.3f}s, {n / fast:,.0f} rows/sec")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", "--rows", help="Number of rows to write", type=int, default=200)
+    bench(parser.parse_args().rows)
@@ -1,5 +1,14 @@
 #!/bin/bash
 
-./punch-card.sh -s && \
-nice -n 20 ./punch-card.sh -a && \
-./punch-card.sh -s
+./punch-card.sh -s || exit
+
+# Push the log as it is written while the app is open, quietly as the app has the terminal
+nice -n 20 ./punch-card.sh --sync-daemon > /dev/null 2>&1 &
+daemon=$!
+
+nice -n 20 ./punch-card.sh -a
+status=$?
+kill $daemon
+wait $daemon
+
+[[ $status -eq 0 ]] && ./punch-card.sh -s
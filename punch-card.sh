@@ -27,4 +27,5 @@ else
     PYENV_VIRTUALENV_DISABLE_PROMPT=1 pyenv activate $ENVNAME
 fi
 
-python src/main.py "$@"
+# exec so signals (e.g. pc.sh stopping the sync daemon) reach python
+exec python src/main.py "$@"
@@ -1,13 +1,14 @@
-import time
 import datetime
 
 from textual.app import App, ComposeResult
-from textual.containers import ScrollableContainer
+from textual.containers import Vertical
 from textual.reactive import reactive
 from textual.widgets import Footer, Header, Button, Static, Input, Pretty, Label
 
 from typing import Any, Final
 import db
+from common import epoch_us
+from writer import State, WriteBehind
 
 # Constants for selectors etc
 hash_: Final = "#"
@@ -19,6 +20,10 @@ start: Final = "start"
 stop: Final = "stop"
 delete: Final = "delete"
 timer_class: Final = "Timer"
+# shortest gap between ticks of the app's clock, in seconds
+min_tick: Final = 0.05
+# lines each Timer row takes up in the ActivityList, height plus margin
+row_height: Final = 6
 
 
 def disable_timers() -> None:
@@ -47,19 +52,38 @@ def pretty_output(text: Any) -> None:
     out.visible = True
 
 
+def utcnow() -> datetime.datetime:
+    return datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc)
+
+
 def add_timer(label: str, elapsed: float = 0.0):
     """Utility function to add timer. If we are loading, anticipate elapsed > 0"""
 
-    # First check that we don't already have one with the same name
-    # if we do, use update_out
-    for timer in app.query(timer_class):
-        if timer.label == label:
+    add_timers([(label, elapsed)])
+
+
+def add_timers(labels_elapsed: list[tuple[str, float]]) -> None:
+    """Utility function to add several timers, the list only creates rows for those in view"""
+
+    added = None
+    for label, elapsed in labels_elapsed:
+        # First check that we don't already have one with the same name
+        # if we do, use update_out
+        if label in app.activities:
             pretty_output(f"Timer with {label} already exists")
-            return
+            continue
 
-    new_timer = Timer(label=label, elapsed=elapsed)
-    app.query_one("#timers").mount(new_timer)
-    new_timer.scroll_visible()
+        added = app.activities[label] = Activity(label=label, elapsed=elapsed)
+
+    if added is not None:
+        app.query_one(ActivityList).show(added)
+
+
+def remove_timer(activity: "Activity") -> None:
+    """Utility function to remove timer"""
+
+    del app.activities[activity.label]
+    app.query_one(ActivityList).refresh_rows()
 
 
 class MyInput(Input):
@@ -73,123 +97,258 @@ class MyInput(Input):
         app.sub_title = f"timer {self.value} added, hit 'r' to remove it"
         self.styles.visibility = "hidden"
         self.value = ""
+        app.query_one(ActivityList).focus()
+
+
+class Activity:
+    """
+    An activity being timed. These are plain objects so that hundreds of them are cheap,
+    only the ones in view have a Timer row showing them
+    """
+
+    __slots__ = ("label", "elapsed", "started_ts", "events")
+
+    def __init__(self, label: str, elapsed: float = 0.0) -> None:
+        self.label = label
+        # log events waiting for the app's writer
+        self.events = app.writer.events(label)
+        # total will keep the time over the period(s) for which the time is active
+        self.elapsed = elapsed
+        # when the current period started, None if not running
+        self.started_ts: datetime.datetime | None = None
+
+    @property
+    def running(self) -> bool:
+        return self.started_ts is not None
+
+    def seconds(self) -> float:
+        """Elapsed time including the current period, if running"""
+
+        if self.started_ts is None:
+            return self.elapsed
+        return self.elapsed + (utcnow() - self.started_ts).total_seconds()
+
+    def log_it(self, state: str) -> datetime.datetime:
+        """Log it with tz-aware UTC timestamp, the app's writer puts it in the db shortly after (unless it is full)"""
+
+        ts = utcnow()
+        self.events.append(State[state], epoch_us(ts))
+
+        # TODO: add verbosity toggle
+        # pretty_output((self.label, state, ts))
+        return ts
+
+    def start(self) -> None:
+        """Start or resume timing"""
+
+        if not self.running:
+            self.started_ts = self.log_it(start)
+
+    def stop(self) -> None:
+        """Stop timing, adding the current period to elapsed"""
+
+        if self.running:
+            ts = self.log_it(stop)
+            self.elapsed += (ts - self.started_ts).total_seconds()
+            self.started_ts = None
+
+    def halt(self) -> None:
+        """Stop timing w/o time update or log entry"""
+
+        self.started_ts = None
 
 
 class TimeDisplay(Static):
-    """Widget to display elapsed time"""
+    """Widget to display elapsed time of the Timer row's activity"""
 
-    start_time = reactive(time.monotonic())
     time = reactive(0.0)
-    # total will keep the time over the period(s) for which the time is active
-    total = reactive(0.0)
 
-    def __init__(self, elapsed: float = 0.0) -> None:
+    def __init__(self) -> None:
         """Instantiation"""
 
-        # Need our own init to handle elapsed
-        # init for Static
         super().__init__()
-        self.elapsed = elapsed
-        # We add the elapsed time from the first the first time further down
-        # this is a bit of a hack
-        self.freshly_loaded = True
+        # Text currently shown, so we only re-render when it changes
+        self.display_text = ""
+
+    @property
+    def activity(self) -> Activity:
+        return self.parent.activity
 
     def on_mount(self) -> None:
         """Event handler called when widget is added to the app"""
 
-        self.update_timer = self.set_interval(1 / 60, self.update_time, pause=True)
+        self.refresh_time()
 
-    def update_time(self) -> None:
-        """Method to update the time to the current time"""
-
-        self.time = self.total + (time.monotonic() - self.start_time)
+    def on_unmount(self) -> None:
+        """Event handler called when widget is removed from the app"""
 
-    def watch_time(self, time: float) -> None:
-        """Called when the time attribute changes"""
+        app.stop_ticking(self)
 
-        # divmod returns a tuple of (quotient, remainder)
-        minutes, seconds = divmod(time, 60)
-        hours, minutes = divmod(minutes, 60)
-        display = f"{hours:02.0f}:{minutes:02.0f}:{seconds:02.0f}"
-        self.update(display)
+    def refresh_time(self) -> None:
+        """Show the activity's time, and tick if it is running"""
 
-    def start(self) -> None:
-        """Method to start or resume timer updating"""
-
-        if self.freshly_loaded:
-            self.start_time = time.monotonic() - self.elapsed
-            self.freshly_loaded = False
+        if self.activity.running:
+            app.start_ticking(self)
         else:
-            self.start_time = time.monotonic()
+            app.stop_ticking(self)
+            self.update_time()
 
-        self.update_timer.resume()
-        app.sub_title = "timer started"
+    def update_time(self) -> None:
+        """Method to update the time to the current time, called by the app's ticker"""
 
-    def stop_no_update(self) -> None:
-        """Method to stop timer updating w/o time update"""
+        self.time = self.activity.seconds()
 
-        self.update_timer.pause()
-        app.sub_title = "timer stopped"
+    def until_next_second(self) -> float:
+        """Seconds until the displayed time next changes"""
 
-    def stop(self) -> None:
-        """Method to stop timer updating"""
+        return 1 - self.activity.seconds() % 1
 
-        self.update_timer.pause()
-        self.total += time.monotonic() - self.start_time
-        self.time = self.total
-        app.sub_title = "timer stopped"
+    def watch_time(self, time: float) -> None:
+        """Called when the time attribute changes"""
+
+        # divmod returns a tuple of (quotient, remainder)
+        minutes, seconds = divmod(int(time), 60)
+        hours, minutes = divmod(minutes, 60)
+        display = f"{hours:02d}:{minutes:02d}:{seconds:02d}"
+        if display != self.display_text:
+            self.display_text = display
+            self.update(display)
 
 
 class Timer(Static):
-    """Timing block associated with each activity"""
+    """Row showing an Activity, rows are reused for whichever activities are in view"""
 
-    def __init__(self, label: str, elapsed: float) -> None:
+    def __init__(self, activity: Activity) -> None:
         # Need our own init to handle
         super().__init__()
-        self.label = label
-        self.elapsed = elapsed
-        # Quasi-log to log state changes
-        self.timer_log = []
+        self.activity = activity
+        self.set_class(activity.running, "started")
 
-    def log_it(self, state: str) -> None:
-        """Log it with tz-aware UTC timestamp"""
+    @property
+    def label(self) -> str:
+        return self.activity.label
 
-        ts = datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc)
+    def bind(self, activity: Activity) -> None:
+        """Show activity in this row instead"""
 
-        log_entry = {"label": self.label, "state": state, "ts": ts, "date": ts.date()}
-        if state == "stop":
-            previous_entry = self.timer_log[-1]
-            self.elapsed += (log_entry["ts"] - previous_entry["ts"]).total_seconds()
-
-        self.timer_log.append(log_entry)
-
-        # TODO: add verbosity toggle
-        # pretty_output(log_entry)
+        self.activity = activity
+        self.set_class(activity.running, "started")
+        self.query_one(Label).update(activity.label)
+        self.query_one(TimeDisplay).refresh_time()
 
     def on_button_pressed(self, event: Button.Pressed) -> None:
         """Event handler called when button is pressed"""
 
         button_id = event.button.id
-        time_display = self.query_one(TimeDisplay)
+        n_dropped = self.activity.events.n_dropped
 
         if button_id == start:
-            time_display.start()
+            self.activity.start()
             self.add_class("started")
+            app.sub_title = "timer started"
         elif button_id == stop:
-            time_display.stop()
+            self.activity.stop()
             self.remove_class("started")
+            app.sub_title = "timer stopped"
         elif button_id == delete:
-            self.remove()
+            self.activity.log_it(delete)
+            remove_timer(self.activity)
+            app.save_state()
             app.sub_title = "timer deleted"
 
-        self.log_it(button_id)
+        if self.activity.events.n_dropped > n_dropped:
+            # The timer carries on regardless, only the log misses it
+            app.sub_title += ", but not logged as too many actions are waiting to be written to the db"
+        if button_id == delete:
+            return
+
+        app.save_state()
+        self.query_one(TimeDisplay).refresh_time()
 
     def compose(self) -> ComposeResult:
         yield Button(start, id=start, variant="success")
         yield Button(stop, id=stop, variant="warning")
         yield Button(delete, id=delete, variant="error")
-        yield Label(self.label)
-        yield TimeDisplay(elapsed=self.elapsed)
+        yield Label(self.activity.label)
+        yield TimeDisplay()
+
+
+class ActivityList(Vertical):
+    """
+    List of activities which only has Timer rows for as many activities as fit, scrolling
+    rebinds the rows to other activities rather than moving widgets around
+    """
+
+    BINDINGS = [
+        ("up", "scroll_rows(-1)", "Up"),
+        ("down", "scroll_rows(1)", "Down"),
+        ("pageup", "scroll_page(-1)", "Page up"),
+        ("pagedown", "scroll_page(1)", "Page down"),
+    ]
+    # Focusable so the bindings work without a row focused
+    can_focus = True
+
+    def __init__(self, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        # index of the activity in the first row
+        self.first_row = 0
+        self.rows: list[Timer] = []
+
+    def n_rows(self) -> int:
+        """How many rows fit"""
+
+        return max(1, self.size.height // row_height)
+
+    def on_resize(self) -> None:
+        self.refresh_rows()
+
+    def on_mouse_scroll_down(self) -> None:
+        self.action_scroll_rows(1)
+
+    def on_mouse_scroll_up(self) -> None:
+        self.action_scroll_rows(-1)
+
+    def action_scroll_rows(self, n: int) -> None:
+        self.first_row += n
+        self.refresh_rows()
+
+    def action_scroll_page(self, n: int) -> None:
+        self.action_scroll_rows(n * self.n_rows())
+
+    def show(self, activity: Activity) -> None:
+        """Scroll so activity is in view"""
+
+        index = list(app.activities.values()).index(activity)
+        if index < self.first_row:
+            self.first_row = index
+        elif index >= self.first_row + self.n_rows():
+            self.first_row = index - self.n_rows() + 1
+        self.refresh_rows()
+
+    def refresh_rows(self) -> None:
+        """Bind rows to the activities in view, adding or removing rows if the number in view has changed"""
+
+        activities = list(app.activities.values())
+        n_rows = min(self.n_rows(), len(activities))
+        self.first_row = max(0, min(self.first_row, len(activities) - n_rows))
+        in_view = activities[self.first_row : self.first_row + n_rows]
+
+        # Grow or shrink the pool of rows to fit
+        if len(self.rows) > n_rows:
+            for row in self.rows[n_rows:]:
+                row.remove()
+            del self.rows[n_rows:]
+        elif len(self.rows) < n_rows:
+            new_rows = [Timer(activity) for activity in in_view[len(self.rows) :]]
+            self.mount(*new_rows)
+            self.rows.extend(new_rows)
+
+        for row, activity in zip(self.rows, in_view):
+            if row.activity is not activity:
+                row.bind(activity)
+
+        if len(activities) > n_rows:
+            app.sub_title = f"activities {self.first_row + 1}-{self.first_row + n_rows} of {len(activities)}"
 
 
 class Punchcard(App[int]):
@@ -209,13 +368,64 @@ class Punchcard(App[int]):
 
     return_value = 0
 
+    def __init__(self, writer: WriteBehind | None = None) -> None:
+        super().__init__()
+        # Everything going to the db goes through the writer's thread
+        self.writer = writer or WriteBehind()
+        # One ticker drives every running TimeDisplay, and only runs while something is running
+        self.running: set[TimeDisplay] = set()
+        self.ticker = None
+        # Activities by label, in the order they were added
+        self.activities: dict[str, Activity] = {}
+
+    def start_ticking(self, time_display: TimeDisplay) -> None:
+        """Have the ticker update time_display"""
+
+        self.running.add(time_display)
+        time_display.update_time()
+        if self.ticker is None:
+            self.schedule_tick()
+
+    def stop_ticking(self, time_display: TimeDisplay) -> None:
+        """Stop the ticker updating time_display, stopping the ticker if nothing is running"""
+
+        self.running.discard(time_display)
+        if not self.running and self.ticker is not None:
+            self.ticker.stop()
+            self.ticker = None
+
+    def schedule_tick(self) -> None:
+        """Next tick is when the soonest running display's seconds roll over"""
+
+        delay = min(time_display.until_next_second() for time_display in self.running)
+        # A little past the boundary so the new second shows, but not so often that lots of
+        # timers out of step with each other keep the ticker busy
+        self.ticker = self.set_timer(max(delay + 0.001, min_tick), self.tick)
+
+    def tick(self) -> None:
+        """Update running displays, each re-renders only if its text has changed"""
+
+        for time_display in self.running:
+            time_display.update_time()
+
+        if self.running:
+            self.schedule_tick()
+        else:
+            self.ticker = None
+
+    def on_mount(self) -> None:
+        """Event handler called when the app has started"""
+
+        self.writer.start()
+        self.query_one(ActivityList).focus()
+
     def action_clear_output(self) -> None:
         pretty_output("")
 
     def compose(self) -> ComposeResult:
         yield Header()
         yield Footer()
-        yield ScrollableContainer(id="timers")
+        yield ActivityList(id="timers")
         yield MyInput(
             placeholder="Enter a name for the activity",
             id=activityname,
@@ -240,7 +450,7 @@ class Punchcard(App[int]):
         activity.focus()
 
     def action_exit_hook(self) -> None:
-        """Save and exit"""
+        """Save and exit, runapp waits for the writer to finish once the app has gone"""
 
         self.action_write_to_db()
         self.exit()
@@ -252,64 +462,53 @@ class Punchcard(App[int]):
 
     def action_remove_timer(self) -> None:
         """An action to remove a timer"""
-        timers = self.query(timer_class)
-        if timers:
-            timers.last().remove()
+        if self.activities:
+            remove_timer(next(reversed(self.activities.values())))
             self.sub_title = "timer removed, hit 'n' to add another"
 
-    def get_timer_state(self, timer: Timer) -> dict[str, Any]:
-        """State dict from Timer object"""
+    def get_timer_state(self, activity: Activity) -> dict[str, Any]:
+        """State dict from Activity object"""
+
+        state = "start" if activity.running else "stop"
+        return dict(state=state, elapsed=activity.elapsed, label=activity.label)
 
-        state = "start" if timer.has_class("started") else "stop"
-        return dict(state=state, elapsed=timer.elapsed, label=timer.label)
+    def save_state(self) -> None:
+        """Queue a snapshot of every activity's state for the writer"""
+
+        ts = utcnow()
+        self.writer.write_state([dict(self.get_timer_state(activity), ts=ts) for activity in self.activities.values()])
 
     def action_view_timer_log(self) -> None:
         """Method to show timer log/state"""
 
-        timers = self.query(timer_class)
-        pretty_output(([timer.timer_log for timer in timers], [self.get_timer_state(timer) for timer in timers]))
+        writer = dict(pending=self.writer.pending(), written=self.writer.n_written, dropped=self.writer.dropped(), last_error=self.writer.last_error)
+        pretty_output((writer, [self.get_timer_state(activity) for activity in self.activities.values()]))
 
     def action_write_to_db(self) -> None:
         """Write log and state to db"""
 
-        n_actions = 0
-        n_states = 0
-        timers = self.query(timer_class)
+        activities = self.activities.values()
 
         # If no timers, nothing to do
-        if len(timers) == 0:
+        if len(activities) == 0:
             pretty_output("No timers present")
             return
         # implied else
 
-        # Loop through and write the timer logs
-        for timer in timers:
+        for activity in activities:
             # stop the timer for good order
-            timer.query_one(TimeDisplay).stop_no_update()
-            timer.remove_class("started")
+            activity.halt()
 
-            # log
-            log = timer.timer_log
-            # If log is not empty
-            if log:
-                # Loop through until empty
-                while log:
-                    # Write each entry to db and pop it off the list at the same time
-                    to_write = log.pop(0)
-                    db.write_timer_log(to_write)
-                    n_actions += 1
-
-        # Loop through and write the states
-        db.clear_state()
-        ts = datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc)
+        for timer in self.query(timer_class):
+            timer.remove_class("started")
+            timer.query_one(TimeDisplay).refresh_time()
 
-        for timer in timers:
-            timer_state = self.get_timer_state(timer)
-            timer_state["ts"] = ts
-            db.write_state(timer_state)
-            n_states += 1
+        # The writer does the actual writing, nudge it so that happens now
+        n_actions = self.writer.pending()
+        self.save_state()
+        self.writer.wake.set()
 
-        pretty_output(f"{n_actions} actions, {n_states} states written to db")
+        pretty_output(f"{n_actions} actions, {len(activities)} states being written to db")
 
     def action_read_from_db(self) -> None:
         """Method to read from db"""
@@ -319,8 +518,7 @@ class Punchcard(App[int]):
             pretty_output("No timers in db")
             return
 
-        for each in inputs:
-            add_timer(label=each.label, elapsed=each.elapsed)
+        add_timers([(each.label, each.elapsed) for each in inputs])
 
         # TODO: add verbosity toggle
         # pretty_output(inputs)
@@ -334,7 +532,15 @@ def runapp() -> int:
     global app
 
     app = Punchcard()
-    return app.run()
+    try:
+        return app.run()
+    finally:
+        # Anything the writer hasn't got to yet
+        app.writer.close()
+        if app.writer.last_error is not None:
+            print(f"Writing to the db failed, {app.writer.pending()} actions not written: {app.writer.last_error}")
+        if app.writer.dropped():
+            print(f"{app.writer.dropped()} actions were dropped while too many were waiting to be written")
 
 
 if __name__ == "__main__":
@@ -1,100 +1,133 @@
 import db
-import pandas as pd
 import datetime
 import pytz
 import pathlib
+import time
 
+from common import utc_tz
 from icalendar import Calendar, Event
 
-from typing import Any
+from typing import Final, Iterable, Iterator
 
+# separates the first and last dates of a range, e.g. 2023-07-01..2023-09-30
+range_separator: Final[str] = ".."
 
-def parse_rows(rows: list[db.TimerLogBase]) -> list[dict[str, Any]]:
+
+def parse_date_range(text: str) -> tuple[datetime.date, datetime.date]:
+    """Parses a date (YYYY-MM-DD) or a range of dates (YYYY-MM-DD..YYYY-MM-DD) into (first date, last date)"""
+
+    since, _, until = text.partition(range_separator)
+    since = datetime.date.fromisoformat(since)
+    until = datetime.date.fromisoformat(until) if until else since
+    if until < since:
+        raise Exception(f"{text} ends before it starts")
+    return since, until
+
+
+def iter_sessions(since: datetime.date, until: datetime.date, conn_str: str = db.default_db_url) -> Iterator[tuple[str, datetime.datetime, datetime.datetime]]:
     """
-    Takes a list of db.TimerLogBase objects and returns a list of dicts
-    which can then be used to create a dataframe
+    (label, start, stop) for sessions which started between since and until (inclusive),
+    from one query over the range which is paired up a chunk at a time
     """
 
-    list_of_dicts = []
+    # pandas is slow to import, so only pay for it when it is needed
+    from pairing import StreamingPairer, events_frame
 
-    for start, stop in zip(rows[::2], rows[1::2]):
-        assert start.label == stop.label
-        assert start.state == "start"
-        assert stop.state == "stop"
+    # The day after until is read as well so sessions which run past midnight get their stop
+    pairer = StreamingPairer()
+    for chunk in db.iter_timer_log_between(since, until + datetime.timedelta(days=1), conn_str=conn_str):
+        sessions, orphans = pairer.feed(events_frame(chunk))
+        for r in orphans[orphans.ts.dt.date <= until].itertuples():
+            print(f"{r.label} started at {r.ts} was not stopped, skipping")
+        for r in sessions.itertuples():
+            start = r.start.to_pydatetime()
+            if start.date() <= until:
+                yield r.label, start, r.stop.to_pydatetime()
 
-        list_of_dicts.append(
-            dict(
-                label=start.label,
-                start=start.ts,
-                stop=stop.ts,
-            )
-        )
+    for r in pairer.running.itertuples():
+        if r.ts.date() <= until:
+            print(f"{r.label} started at {r.ts} has not been stopped yet, skipping")
 
-    return list_of_dicts
 
-
-def create_cal_object(label: str, start: datetime.datetime, end: datetime.datetime, ts: datetime.datetime) -> Calendar():
+def create_event(label: str, start: datetime.datetime, end: datetime.datetime, ts: datetime.datetime) -> Event:
     """
-    Creates an icalendar.Calendar from label, start, end and ts datetime.datetime objects
+    Creates an icalendar.Event from label, start, end and ts datetime.datetime objects
     """
 
     assert isinstance(start, datetime.datetime)
     assert isinstance(end, datetime.datetime)
     assert isinstance(ts, datetime.datetime)
 
-    # See: https://icalendar.readthedocs.io/en/latest/usage.html#example
-    cal = Calendar()
-    cal.add("prodid", "-//punch-card//github.com/algrt-hm/punch-card//")
-    cal.add("version", "2.0")
+    # Times are stored in UTC, SQLite hands them back without a timezone
+    start, end = [utc_tz(dt) if dt.tzinfo is None else dt for dt in (start, end)]
 
     event = Event()
+    event.add("uid", f"{start.strftime('%Y%m%dT%H%M%S%f')}-{label}@punch-card")
     event.add("summary", label)
     event.add("dtstart", start)
     event.add("dtend", end)
     event.add("dtstamp", ts)
-    cal.add_component(event)
 
-    return cal
+    return event
 
 
-def create_file_name(label: str, start: datetime.datetime, end: datetime.datetime, ts: datetime.datetime) -> str:
+def ical_chunks(sessions: Iterable[tuple[str, datetime.datetime, datetime.datetime]], ts: datetime.datetime) -> Iterator[bytes]:
     """
-    Returns filename string from label, start, end and ts datetime.datetime objects
+    A calendar holding an event for each (label, start, end) in sessions, as bytes to be
+    written out one after the other so the whole calendar is never in memory
     """
 
-    assert isinstance(start, datetime.datetime)
-    assert isinstance(end, datetime.datetime)
-    assert isinstance(ts, datetime.datetime)
+    # See: https://icalendar.readthedocs.io/en/latest/usage.html#example
+    cal = Calendar()
+    cal.add("prodid", "-//punch-card//github.com/algrt-hm/punch-card//")
+    cal.add("version", "2.0")
+
+    # An empty calendar is the header followed by the footer
+    footer = b"END:VCALENDAR\r\n"
+    yield cal.to_ical()[: -len(footer)]
+    for label, start, end in sessions:
+        yield create_event(label, start, end, ts).to_ical()
+    yield footer
+
+
+def create_file_name(since: datetime.date, until: datetime.date, ts: datetime.datetime) -> str:
+    """
+    Returns filename string from the since and until dates and ts datetime.datetime
+    """
 
-    def fmt(dt):
-        return dt.strftime("%Y-%m-%d-%X").replace(":", "")
+    extension = ".ics"
+    return "_".join([ts.strftime("%Y-%m-%d-%X").replace(":", ""), "punch-card", str(since), str(until)]) + extension
 
-    extension = ".vcs"
-    label = label.replace("-", "").replace(" ", "_").replace("/", "_")
-    return "_".join([fmt(ts), label, fmt(start), fmt(end)]) + extension
 
+def cal(since: datetime.date, until: datetime.date | None = None, conn_str: str = db.default_db_url) -> pathlib.Path | None:
+    """Writes sessions which started from since up to and including until (defaults to since) to one .ics file"""
 
-def cal(date_of_interest: datetime.date) -> None:
+    start = time.perf_counter()
+    until = until or since
     ts = datetime.datetime.now(tz=pytz.utc)
-    df = pd.DataFrame(parse_rows(db.read_timer_log_date(date_of_interest)))
+    path = pathlib.Path(create_file_name(since, until, ts))
 
-    if len(df) == 0:
-        print(f"No records for {date_of_interest}")
-        return
-    else:
-        print(df.to_markdown(index=False))
+    n_events = 0
 
-    for _, r in df.iterrows():
-        params = dict(label=r.label, start=r.start, end=r.stop, ts=ts)
-        cal = create_cal_object(**params)
-        file_name = create_file_name(**params)
-        pathlib.Path(file_name).write_bytes(cal.to_ical())
-        print(f"{file_name} written")
+    def counted(sessions: Iterable[tuple[str, datetime.datetime, datetime.datetime]]) -> Iterator[tuple[str, datetime.datetime, datetime.datetime]]:
+        nonlocal n_events
+        for session in sessions:
+            n_events += 1
+            yield session
 
+    with path.open("wb") as f:
+        for chunk in ical_chunks(counted(iter_sessions(since, until, conn_str=conn_str)), ts):
+            f.write(chunk)
 
-if __name__ == "__main__":
-    stop_date = datetime.date.today() - datetime.timedelta(days=7)
+    if n_events == 0:
+        path.unlink()
+        print(f"No records from {since} to {until}")
+        return None
 
-    while stop_date < datetime.date.today():
-        cal(stop_date)
-        stop_date += datetime.timedelta(days=1)
+    print(f"{n_events} events from {since} to {until} written to {path} in {time.perf_counter() - start:.2f}s")
+    return path
+
+
+if __name__ == "__main__":
+    # The last week, not including today
+    cal(datetime.date.today() - datetime.timedelta(days=7), datetime.date.today() - datetime.timedelta(days=1))
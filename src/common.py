@@ -7,3 +7,12 @@ def utc_tz(dt: datetime.datetime) -> datetime.datetime:
 
 def no_tz(dt: datetime.datetime) -> datetime.datetime:
     return dt.replace(tzinfo=None)
+
+
+def epoch_us(dt: datetime.datetime) -> int:
+    """Microseconds since the epoch, naive datetimes are taken to be UTC"""
+
+    epoch = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+    if dt.tzinfo is None:
+        dt = utc_tz(dt)
+    return (dt - epoch) // datetime.timedelta(microseconds=1)
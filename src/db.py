@@ -2,11 +2,54 @@ import sqlalchemy
 import datetime
 import pydantic
 import sqlalchemy.orm
+import sqlalchemy.ext.compiler
+import sqlalchemy.dialects.sqlite
+import sqlalchemy.dialects.postgresql
+import contextlib
 import functools
-from typing import Any, Final
+import itertools
+import uuid
+import csv
+import io
+import metrics
+from common import epoch_us
+from typing import Any, Final, Iterator, NamedTuple
 
 default_db_name: Final[str] = "punch-card"
 default_db_url: Final[str] = f"sqlite:///{default_db_name}.sqlite3"
+# device that log rows written before devices were tracked are attributed to
+legacy_device: Final[str] = "legacy"
+# the version vector's checksum is the sum of seqs modulo this, which keeps it well away from
+# overflowing even for legacy seqs (epoch microseconds)
+seq_checksum_modulus: Final[int] = 2**31 - 1
+# rows per INSERT when writing the log to SQLite
+insert_batch_size: Final[int] = 5000
+
+# engine/pool options by backend; pre-ping means a connection dropped while the app
+# sits idle is replaced on checkout rather than failing the next write. A local SQLite
+# file can't drop, so it goes without (and the pings the writer and sync daemon would cost)
+default_engine_options: Final[dict[str, dict[str, Any]]] = {
+    "postgresql": dict(pool_size=5, max_overflow=5, pool_timeout=30, pool_recycle=1800, pool_pre_ping=True, connect_args=dict(connect_timeout=10)),
+}
+# overrides per connection string, see set_engine_options
+engine_options: dict[str, dict[str, Any]] = {}
+
+# pragmas set on each new connection to an SQLite file. WAL lets readers (sync, reports, the
+# notebook) carry on while the app writes and vice versa, and with it synchronous=NORMAL only
+# syncs to disk at checkpoints rather than on every commit (a crash can lose the last commits,
+# but can't corrupt the db)
+default_sqlite_pragmas: Final[dict[str, Any]] = dict(
+    journal_mode="wal",
+    synchronous="normal",
+    # milliseconds to wait for another connection's write lock before "database is locked"
+    busy_timeout=10_000,
+    mmap_size=256 * 1024 * 1024,
+    # negative means KiB rather than pages, so 64MiB
+    cache_size=-64 * 1024,
+)
+# overrides per connection string, see set_sqlite_pragmas
+sqlite_pragmas: dict[str, dict[str, Any]] = {}
+checkpoint_modes: Final[tuple[str, ...]] = ("PASSIVE", "FULL", "RESTART", "TRUNCATE")
 
 # metadata for sqlalchemy tables
 metadata = sqlalchemy.MetaData()
@@ -25,6 +68,9 @@ class TimerLogPydantic(pydantic.BaseModel):
     state: str
     date: datetime.date
     ts: datetime.datetime
+    # filled in by write_timer_logs for rows logged on this device
+    device: str | None = None
+    seq: int | None = None
 
 
 # table info for DDL creation etc
@@ -35,6 +81,15 @@ timer_log_table = sqlalchemy.Table(
     sqlalchemy.Column("state", sqlalchemy.Text, nullable=False),
     sqlalchemy.Column("date", sqlalchemy.Date, nullable=False),
     sqlalchemy.Column("ts", sqlalchemy.DateTime(timezone=True), primary_key=True),
+    # device which logged the row and its position in that device's log, nullable
+    # as databases from before devices were tracked get them filled in on migration
+    sqlalchemy.Column("device", sqlalchemy.Text),
+    sqlalchemy.Column("seq", sqlalchemy.BigInteger),
+    # read_timer_log_date filters on date, reports group by label
+    sqlalchemy.Index("ix_timer_log_date_ts", "date", "ts"),
+    sqlalchemy.Index("ix_timer_log_label_ts", "label", "ts"),
+    # sync fetches rows for a device above a seq
+    sqlalchemy.Index("ix_timer_log_device_seq", "device", "seq", unique=True),
 )
 
 
@@ -46,11 +101,51 @@ class TimerLogBase(Base):
     state = sqlalchemy.Column(sqlalchemy.Text, nullable=False)
     date = sqlalchemy.Column(sqlalchemy.Date, nullable=False)
     ts = sqlalchemy.Column(sqlalchemy.DateTime(timezone=True), primary_key=True)
+    device = sqlalchemy.Column(sqlalchemy.Text)
+    seq = sqlalchemy.Column(sqlalchemy.BigInteger)
 
     def __repr__(self) -> str:
         return f"TimerLogDB(label={self.label!r}, state={self.state!r}), date={self.date!r}), ts={self.ts!r})"
 
 
+# plain record for the log in the same column order as timer_log, used by the bulk paths
+# (sync, rebuild, export) which don't need ORM objects or per-row pydantic validation
+class LogRow(NamedTuple):
+    label: str
+    state: str
+    date: datetime.date
+    ts: datetime.datetime
+    device: str | None = None
+    seq: int | None = None
+
+
+# types allowed in each column of a LogRow
+log_row_types: Final[dict[str, tuple[type, ...]]] = dict(
+    label=(str,),
+    state=(str,),
+    date=(datetime.date,),
+    ts=(datetime.datetime,),
+    device=(str, type(None)),
+    seq=(int, type(None)),
+)
+
+
+def validate_log_rows(rows: list[LogRow]) -> None:
+    """Checks a batch of log rows a column at a time, which only looks at each distinct type once"""
+
+    if not rows:
+        return
+
+    if set(map(len, rows)) != {len(LogRow._fields)}:
+        raise Exception(f"Log rows must have {len(LogRow._fields)} fields: {LogRow._fields}")
+
+    for name, column in zip(LogRow._fields, zip(*rows)):
+        for value_type in set(map(type, column)):
+            # datetime is a subclass of date
+            if not issubclass(value_type, log_row_types[name]) or (name == "date" and issubclass(value_type, datetime.datetime)):
+                raise Exception(f"Log rows have a {value_type.__name__} in {name}, expected {' or '.join(t.__name__ for t in log_row_types[name])}")
+
+
 ###
 # database setup for state
 ###
@@ -85,14 +180,263 @@ class TimerStateBase(Base):
         return f"TimerStateDB(label={self.label!r}, elapsed={self.elapsed!r}, ts={self.ts!r})"
 
 
+###
+# database setup for sync
+###
+
+# version vector: highest seq, number of rows and a checksum of the seqs held for each device.
+# Seqs can have gaps (legacy ones do) so the same highest seq and number of rows on both sides
+# doesn't mean the same rows, the checksum tells them apart
+timer_log_vector_table = sqlalchemy.Table(
+    "timer_log_vector",
+    metadata,
+    sqlalchemy.Column("device", sqlalchemy.Text, primary_key=True),
+    sqlalchemy.Column("seq", sqlalchemy.BigInteger, nullable=False),
+    sqlalchemy.Column("n_rows", sqlalchemy.BigInteger, nullable=False),
+    sqlalchemy.Column("checksum", sqlalchemy.BigInteger, nullable=False),
+)
+
+# single row table holding the id of the device this database belongs to
+device_table = sqlalchemy.Table(
+    "device",
+    metadata,
+    sqlalchemy.Column("id", sqlalchemy.Text, primary_key=True),
+)
+
+
+###
+# database setup for daily totals
+###
+
+# seconds and number of start/stop sessions per label per day (of the start), kept up to
+# date as log rows are written so summaries don't need to go through the log
+daily_totals_table = sqlalchemy.Table(
+    "daily_totals",
+    metadata,
+    sqlalchemy.Column("label", sqlalchemy.Text, primary_key=True),
+    sqlalchemy.Column("date", sqlalchemy.Date, primary_key=True),
+    sqlalchemy.Column("seconds", sqlalchemy.Float, nullable=False),
+    sqlalchemy.Column("sessions", sqlalchemy.Integer, nullable=False),
+)
+
+
+###
+# database setup for rebuilding state from the log
+###
+
+# single row table holding how far through the log the last rebuild got
+rebuild_checkpoint_table = sqlalchemy.Table(
+    "rebuild_checkpoint",
+    metadata,
+    sqlalchemy.Column("ts", sqlalchemy.DateTime(timezone=True), primary_key=True),
+    sqlalchemy.Column("n_rows", sqlalchemy.BigInteger, nullable=False),
+)
+
+# running total for each label as of the checkpoint, and when it was started if it was running
+rebuild_totals_table = sqlalchemy.Table(
+    "rebuild_totals",
+    metadata,
+    sqlalchemy.Column("label", sqlalchemy.Text, primary_key=True),
+    sqlalchemy.Column("elapsed", sqlalchemy.Float, nullable=False),
+    sqlalchemy.Column("start_ts", sqlalchemy.DateTime(timezone=True)),
+)
+
+
+###
+# SQL which differs between SQLite and Postgres
+###
+
+
+class epoch_us_sql(sqlalchemy.sql.functions.FunctionElement):
+    """Timestamp column in epoch microseconds, computed in the database"""
+
+    type = sqlalchemy.BigInteger()
+    inherit_cache = True
+
+
+@sqlalchemy.ext.compiler.compiles(epoch_us_sql)
+def compile_epoch_us_sql(element, compiler, **kw) -> str:
+    ts = compiler.process(element.clauses, **kw)
+    return f"CAST(EXTRACT(EPOCH FROM {ts}) * 1000000 AS BIGINT)"
+
+
+@sqlalchemy.ext.compiler.compiles(epoch_us_sql, "sqlite")
+def compile_epoch_us_sql_sqlite(element, compiler, **kw) -> str:
+    # SQLAlchemy stores datetimes in SQLite as 'YYYY-MM-DD HH:MM:SS.ffffff' text. strftime rounds
+    # the fraction to milliseconds (so .9996 would carry into the seconds), it only gets the seconds
+    ts = compiler.process(element.clauses, **kw)
+    return f"(CAST(strftime('%s', substr({ts}, 1, 19)) AS INTEGER) * 1000000 + CAST(substr({ts}, 21, 6) AS INTEGER))"
+
+
+# periods which totals can be reported by
+periods: Final[tuple[str, ...]] = ("day", "week", "month")
+
+
+class period_start_sql(sqlalchemy.sql.functions.FunctionElement):
+    """First day of the day/week (from Monday)/month a date column falls in, computed in the database"""
+
+    type = sqlalchemy.Date()
+    # the period isn't one of the clauses so the compiled SQL can't be cached on them alone
+    inherit_cache = False
+
+    def __init__(self, date: Any, period: str):
+        if period not in periods:
+            raise Exception(f"Period must be one of {periods}, not {period}")
+        self.period = period
+        super().__init__(date)
+
+
+@sqlalchemy.ext.compiler.compiles(period_start_sql)
+def compile_period_start_sql(element, compiler, **kw) -> str:
+    date = compiler.process(element.clauses, **kw)
+    if element.period == "day":
+        return f"CAST({date} AS DATE)"
+    return f"CAST(date_trunc('{element.period}', {date}) AS DATE)"
+
+
+@sqlalchemy.ext.compiler.compiles(period_start_sql, "sqlite")
+def compile_period_start_sql_sqlite(element, compiler, **kw) -> str:
+    date = compiler.process(element.clauses, **kw)
+    if element.period == "day":
+        return f"date({date})"
+    if element.period == "week":
+        # strftime('%w') counts from Sunday = 0
+        return f"date({date}, '-' || ((CAST(strftime('%w', {date}) AS INTEGER) + 6) % 7) || ' days')"
+    return f"date({date}, 'start of month')"
+
+
+###
+# Migrations for databases created by earlier versions
+###
+
+
+def add_missing_columns(engine: sqlalchemy.engine.base.Engine) -> set[str]:
+    """Adds columns which are in the metadata but not in the database, returns the tables altered"""
+
+    altered = set()
+    inspector = sqlalchemy.inspect(engine)
+    with engine.begin() as conn:
+        for table in metadata.sorted_tables:
+            have_columns = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in have_columns:
+                    column_type = column.type.compile(dialect=engine.dialect)
+                    conn.execute(sqlalchemy.text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+                    altered.add(table.name)
+    return altered
+
+
+def stamp_legacy_rows(engine: sqlalchemy.engine.base.Engine) -> int:
+    """
+    Attributes log rows without a device to legacy_device, using the timestamp in epoch
+    microseconds as seq so that every database numbers the same row the same way
+    """
+
+    select_statement = sqlalchemy.select(timer_log_table.c.ts).where(timer_log_table.c.device.is_(None))
+    update_statement = timer_log_table.update().where(timer_log_table.c.ts == sqlalchemy.bindparam("b_ts")).values(device=legacy_device, seq=sqlalchemy.bindparam("b_seq"))
+
+    with engine.begin() as conn:
+        stamps = [dict(b_ts=ts, b_seq=epoch_us(ts)) for ts in conn.scalars(select_statement)]
+        if stamps:
+            conn.execute(update_statement, stamps)
+
+    return len(stamps)
+
+
+def rebuild_timer_log_vector(engine: sqlalchemy.engine.base.Engine) -> None:
+    """Recomputes the version vector from the log"""
+
+    c = timer_log_table.c
+    checksum = sqlalchemy.func.sum(c.seq % seq_checksum_modulus)
+    select_statement = sqlalchemy.select(c.device, sqlalchemy.func.max(c.seq), sqlalchemy.func.count(), checksum).where(c.device.is_not(None)).group_by(c.device)
+
+    with engine.begin() as conn:
+        conn.execute(timer_log_vector_table.delete())
+        conn.execute(timer_log_vector_table.insert().from_select(["device", "seq", "n_rows", "checksum"], select_statement))
+
+
+def rebuild_daily_totals_table(engine: sqlalchemy.engine.base.Engine) -> None:
+    """Recomputes daily_totals from the whole log, pairing events in the database with window functions"""
+
+    c = timer_log_table.c
+    us = epoch_us_sql(c.ts)
+    window = dict(partition_by=c.label, order_by=c.ts)
+    events = sqlalchemy.select(
+        c.label,
+        c.state,
+        us.label("us"),
+        sqlalchemy.func.lag(c.state).over(**window).label("previous_state"),
+        sqlalchemy.func.lag(us).over(**window).label("previous_us"),
+        sqlalchemy.func.lag(c.date).over(**window).label("previous_date"),
+    ).subquery()
+    sessions = (
+        sqlalchemy.select(
+            events.c.label,
+            events.c.previous_date,
+            sqlalchemy.func.sum(events.c.us - events.c.previous_us) / 1_000_000.0,
+            sqlalchemy.func.count(),
+        )
+        .where(events.c.state == "stop", events.c.previous_state == "start")
+        .group_by(events.c.label, events.c.previous_date)
+    )
+
+    with engine.begin() as conn:
+        conn.execute(daily_totals_table.delete())
+        conn.execute(daily_totals_table.insert().from_select(["label", "date", "seconds", "sessions"], sessions))
+
+
 ###
 # Some helper functions to abstract away inserts etc
 ###
 
 
+def set_engine_options(conn_str: str, **options: Any) -> None:
+    """
+    Overrides engine/pool options (pool_size, pool_recycle, pool_timeout etc, see
+    sqlalchemy.create_engine) for conn_str, must be called before its engine is first used
+    """
+
+    engine_options[conn_str] = options
+
+
+def get_engine_options(conn_str: str) -> dict[str, Any]:
+    options = dict(default_engine_options.get(sqlalchemy.engine.make_url(conn_str).get_backend_name(), {}))
+    options.update(engine_options.get(conn_str, {}))
+    return options
+
+
+def set_sqlite_pragmas(conn_str: str, **pragmas: Any) -> None:
+    """
+    Overrides pragmas from default_sqlite_pragmas for conn_str (None leaves SQLite's own default,
+    e.g. journal_mode=None for a rollback journal), must be called before its engine is first used
+    """
+
+    sqlite_pragmas[conn_str] = pragmas
+
+
+def get_sqlite_pragmas(conn_str: str) -> dict[str, Any]:
+    pragmas = dict(default_sqlite_pragmas)
+    pragmas.update(sqlite_pragmas.get(conn_str, {}))
+    return {name: value for name, value in pragmas.items() if value is not None}
+
+
+def is_sqlite_file(url: sqlalchemy.engine.URL) -> bool:
+    return url.get_backend_name() == "sqlite" and url.database not in (None, "", ":memory:")
+
+
 @functools.cache
 def get_engine_and_ddl(conn_str: str) -> sqlalchemy.engine.base.Engine:
-    engine = sqlalchemy.create_engine(conn_str)
+    engine = sqlalchemy.create_engine(conn_str, **get_engine_options(conn_str))
+
+    if is_sqlite_file(engine.url):
+        pragmas = get_sqlite_pragmas(conn_str)
+
+        @sqlalchemy.event.listens_for(engine, "connect")
+        def set_pragmas(dbapi_conn, connection_record) -> None:
+            cursor = dbapi_conn.cursor()
+            for name, value in pragmas.items():
+                cursor.execute(f"PRAGMA {name} = {value}")
+            cursor.close()
 
     # check we have what we expect from the matadata, otherwise
     # get the DLL done
@@ -107,6 +451,24 @@ def get_engine_and_ddl(conn_str: str) -> sqlalchemy.engine.base.Engine:
         # Have {have_tables} tables, expect {expected_tables} tables, will create
         metadata.create_all(engine)
 
+    altered = add_missing_columns(engine)
+
+    # Databases created before an index was added to the metadata won't have it
+    # so create anything which is missing
+    for table in metadata.sorted_tables:
+        have_indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in have_indexes:
+                index.create(engine)
+
+    # Rows from before devices were tracked, or a vector table which has just been created (or
+    # given a column), mean the version vector needs (re)building
+    if stamp_legacy_rows(engine) or timer_log_vector_table.name not in have_tables or timer_log_vector_table.name in altered:
+        rebuild_timer_log_vector(engine)
+
+    if daily_totals_table.name not in have_tables:
+        rebuild_daily_totals_table(engine)
+
     return engine
 
 
@@ -125,38 +487,319 @@ def get_test_engine_and_session() -> tuple[sqlalchemy.engine.base.Engine, sqlalc
 
 
 @functools.cache
-def get_session(conn_str: str) -> sqlalchemy.orm.session.Session:
+def get_sessionmaker(conn_str: str) -> sqlalchemy.orm.session.sessionmaker:
     # This seems a bit convoluted but it doesn't feel tidy to for Session() to be global
     # this will be whatever store
     engine = get_engine_and_ddl(conn_str=conn_str)
-    # a sessionmaker(), also in the same scope as the engine
-    Session = sqlalchemy.orm.sessionmaker(engine)
-    return Session()
+    # a sessionmaker(), also in the same scope as the engine; objects stay readable once
+    # the session they were loaded in is closed
+    return sqlalchemy.orm.sessionmaker(engine, expire_on_commit=False)
+
+
+def get_session(conn_str: str) -> sqlalchemy.orm.session.Session:
+    """A new session for one unit of work, use as a context manager so it goes back to the pool"""
+
+    return get_sessionmaker(conn_str=conn_str)()
+
+
+@contextlib.contextmanager
+def begin_write(engine: sqlalchemy.engine.base.Engine) -> Iterator[sqlalchemy.engine.Connection]:
+    """
+    engine.begin() for transactions which read what they are about to update. SQLite otherwise
+    takes the write lock at the first write, so another writer (e.g. the sync daemon) can commit
+    in between and what was read is stale; postgres locks the rows read with FOR UPDATE
+    """
 
+    with engine.begin() as conn:
+        if engine.dialect.name == "sqlite":
+            conn.exec_driver_sql("BEGIN IMMEDIATE")
+        yield conn
 
+
+@metrics.instrument
+def checkpoint(mode: str = "PASSIVE", conn_str: str = default_db_url) -> tuple[int, int, int] | None:
+    """
+    Copies what is in an SQLite db's write-ahead log back into the db (TRUNCATE also empties the
+    log file), returns (busy, pages in the log, pages copied) or None for other databases. SQLite
+    does this itself when the log gets big, but can't while a reader needs what is in it
+    """
+
+    if mode not in checkpoint_modes:
+        raise Exception(f"Checkpoint mode must be one of {checkpoint_modes}, not {mode}")
+
+    engine = get_engine_and_ddl(conn_str=conn_str)
+    if not is_sqlite_file(engine.url):
+        return None
+    with engine.connect() as conn:
+        return tuple(conn.exec_driver_sql(f"PRAGMA wal_checkpoint({mode})").one())
+
+
+@metrics.instrument
 def write_timer_log(row: dict[Any], conn_str: str = default_db_url) -> None:
-    # Put into pydantic class first so we catch any issues
-    stg = TimerLogPydantic(**row)
-    insert_data = TimerLogBase(label=stg.label, state=stg.state, date=stg.date, ts=stg.ts)
-    with get_session(conn_str=conn_str) as session:
-        session.add(insert_data)
-        session.commit()
+    write_timer_logs([row], conn_str=conn_str)
 
 
-def read_timer_log(conn_str: str = default_db_url) -> list[TimerLogBase]:
-    with get_session(conn_str=conn_str) as session:
-        statement = sqlalchemy.select(TimerLogBase).order_by(TimerLogBase.ts)
-        ret = session.scalars(statement).all()
+@functools.cache
+def get_device_id(conn_str: str = default_db_url) -> str:
+    """Id of the device the database belongs to, created on first use"""
+
+    engine = get_engine_and_ddl(conn_str=conn_str)
+    with begin_write(engine) as conn:
+        device_id = conn.scalar(sqlalchemy.select(device_table.c.id))
+        if device_id is None:
+            device_id = uuid.uuid4().hex
+            conn.execute(device_table.insert(), dict(id=device_id))
+
+    return device_id
+
+
+def insert_timer_logs_sqlite(conn: sqlalchemy.engine.Connection, rows: list[LogRow]) -> list[sqlalchemy.engine.Row]:
+    """INSERT ... ON CONFLICT DO NOTHING in batches, returns the rows actually inserted"""
+
+    statement = sqlalchemy.dialects.sqlite.insert(timer_log_table).on_conflict_do_nothing().returning(*timer_log_table.columns)
+    ret = []
+    for i in range(0, len(rows), insert_batch_size):
+        ret.extend(conn.execute(statement, [row._asdict() for row in rows[i : i + insert_batch_size]]))
     return ret
 
 
-def read_timer_log_date(date: datetime.date, conn_str: str = default_db_url) -> list[TimerLogBase]:
-    with get_session(conn_str=conn_str) as session:
-        statement = sqlalchemy.select(TimerLogBase).where(TimerLogBase.date == date).order_by(TimerLogBase.ts)
-        ret = session.scalars(statement).all()
+def insert_timer_logs_postgres(conn: sqlalchemy.engine.Connection, rows: list[LogRow]) -> list[sqlalchemy.engine.Row]:
+    """COPY into a staging table then merge, returns the rows actually inserted"""
+
+    column_list = ", ".join(LogRow._fields)
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+
+    conn.exec_driver_sql(f"CREATE TEMPORARY TABLE timer_log_staging (LIKE {timer_log_table.name}) ON COMMIT DROP")
+    # COPY goes through psycopg2 directly, on the same connection so it is in the same transaction
+    # csv writes "" and None alike as an empty field, which COPY reads as NULL; labels can be
+    # empty (and label and state are NOT NULL) so for them it means ""
+    with conn.connection.dbapi_connection.cursor() as cursor:
+        cursor.copy_expert(f"COPY timer_log_staging ({column_list}) FROM STDIN WITH (FORMAT csv, FORCE_NOT_NULL (label, state))", buffer)
+
+    merge = f"INSERT INTO {timer_log_table.name} ({column_list}) SELECT {column_list} FROM timer_log_staging ON CONFLICT DO NOTHING RETURNING {column_list}"
+    return conn.exec_driver_sql(merge).all()
+
+
+def upsert_daily_totals(conn: sqlalchemy.engine.Connection, totals: dict[tuple[str, datetime.date], tuple[float, int]]) -> None:
+    """
+    Adds {(label, date): (seconds, sessions)} to daily_totals, rows whose sessions are all
+    taken back out are deleted (as a rebuild wouldn't have them)
+    """
+
+    if not totals:
+        return
+
+    c = daily_totals_table.c
+    insert = sqlalchemy.dialects.postgresql.insert if conn.dialect.name == "postgresql" else sqlalchemy.dialects.sqlite.insert
+    statement = insert(daily_totals_table)
+    statement = statement.on_conflict_do_update(
+        index_elements=[c.label, c.date],
+        set_=dict(seconds=c.seconds + statement.excluded.seconds, sessions=c.sessions + statement.excluded.sessions),
+    )
+    conn.execute(statement, [dict(label=label, date=date, seconds=seconds, sessions=sessions) for (label, date), (seconds, sessions) in totals.items()])
+
+    emptied = [dict(emptied_label=label, emptied_date=date) for (label, date), (_, sessions) in totals.items() if sessions < 0]
+    if emptied:
+        statement = daily_totals_table.delete().where(c.label == sqlalchemy.bindparam("emptied_label"), c.date == sqlalchemy.bindparam("emptied_date"), c.sessions <= 0)
+        conn.execute(statement, emptied)
+
+
+def fold_into_daily_totals(conn: sqlalchemy.engine.Connection, inserted: list[sqlalchemy.engine.Row]) -> None:
+    """
+    Adds sessions completed by newly inserted log rows to daily_totals. A session is a start
+    followed directly by a stop for the same label; the log around the new rows is read so
+    starts/stops from earlier batches or other devices are paired up, and a session which
+    new rows land in the middle of (e.g. from a sync) is taken back out
+    """
+
+    c = timer_log_table.c
+    inserted_ts_by_label: dict[str, set[datetime.datetime]] = {}
+    for row in inserted:
+        inserted_ts_by_label.setdefault(row.label, set()).add(row.ts)
+
+    totals: dict[tuple[str, datetime.date], tuple[float, int]] = {}
+
+    def add_sessions(events: list[sqlalchemy.engine.Row], sign: int) -> None:
+        for previous, event in zip(events, events[1:]):
+            if previous.state == "start" and event.state == "stop":
+                seconds, sessions = totals.get((label, previous.date), (0.0, 0))
+                totals[(label, previous.date)] = (seconds + sign * (event.ts - previous.ts).total_seconds(), sessions + sign)
+
+    for label, inserted_ts in inserted_ts_by_label.items():
+        # Neighbouring events either side of what was inserted, which uses the (label, ts) index
+        before = conn.scalar(sqlalchemy.select(sqlalchemy.func.max(c.ts)).where(c.label == label, c.ts < min(inserted_ts)))
+        after = conn.scalar(sqlalchemy.select(sqlalchemy.func.min(c.ts)).where(c.label == label, c.ts > max(inserted_ts)))
+        statement = sqlalchemy.select(c.state, c.ts, c.date).where(c.label == label, c.ts >= (before or min(inserted_ts)), c.ts <= (after or max(inserted_ts))).order_by(c.ts)
+        events = conn.execute(statement).all()
+
+        # sessions in this stretch of the log now, less those counted before the insert
+        add_sessions(events, 1)
+        add_sessions([event for event in events if event.ts not in inserted_ts], -1)
+
+    upsert_daily_totals(conn, {key: value for key, value in totals.items() if value != (0.0, 0)})
+
+
+@metrics.instrument
+def rebuild_daily_totals(conn_str: str = default_db_url) -> None:
+    """Recomputes daily_totals from the whole log"""
+
+    rebuild_daily_totals_table(get_engine_and_ddl(conn_str=conn_str))
+
+
+@metrics.instrument
+def read_daily_totals(since: datetime.date | None = None, until: datetime.date | None = None, conn_str: str = default_db_url) -> list[sqlalchemy.engine.Row]:
+    """Daily totals, optionally for dates from since up to and including until"""
+
+    c = daily_totals_table.c
+    statement = sqlalchemy.select(daily_totals_table).order_by(c.date, c.label)
+    if since is not None:
+        statement = statement.where(c.date >= since)
+    if until is not None:
+        statement = statement.where(c.date <= until)
+
+    engine = get_engine_and_ddl(conn_str=conn_str)
+    with engine.connect() as conn:
+        ret = conn.execute(statement).all()
     return ret
 
 
+@metrics.instrument
+def write_timer_logs(rows: list[dict[Any]], conn_str: str = default_db_url) -> int:
+    """
+    Writes a batch of log rows (as dicts) in a single transaction, returns the number of rows
+    written. Each row is validated with pydantic before anything is sent to the database,
+    see write_log_rows for the bulk path
+    """
+
+    # Put into pydantic class first so we catch any issues before we start writing
+    return store_log_rows([LogRow(**TimerLogPydantic(**row).dict()) for row in rows], conn_str=conn_str)
+
+
+@metrics.instrument
+def write_log_rows(rows: list[LogRow], conn_str: str = default_db_url) -> int:
+    """
+    Writes a batch of LogRows in a single transaction, returns the number of rows written.
+    The batch is validated a column at a time before anything is sent to the database
+    """
+
+    validate_log_rows(rows)
+    return store_log_rows(rows, conn_str=conn_str)
+
+
+@metrics.instrument
+def store_log_rows(rows: list[LogRow], conn_str: str = default_db_url) -> int:
+    """
+    Rows which are already there (by ts) are skipped, so writing the same rows twice is a no-op.
+    Rows without a device are stamped with this database's device id and the next seqs,
+    and the version vector and daily totals are updated in the same transaction
+    """
+
+    if not rows:
+        return 0
+
+    engine = get_engine_and_ddl(conn_str=conn_str)
+    device_id = get_device_id(conn_str=conn_str) if any(row.device is None for row in rows) else None
+
+    if engine.dialect.name == "postgresql":
+        insert_timer_logs = insert_timer_logs_postgres
+    elif engine.dialect.name == "sqlite":
+        insert_timer_logs = insert_timer_logs_sqlite
+    else:
+        raise Exception(f"Writing the log to {engine.dialect.name} is not supported")
+
+    # commits once at the end
+    with begin_write(engine) as conn:
+        devices = ({row.device for row in rows} | {device_id}) - {None}
+        vector_statement = sqlalchemy.select(timer_log_vector_table).where(timer_log_vector_table.c.device.in_(devices)).with_for_update()
+        vector = {row.device: (row.seq, row.n_rows, row.checksum) for row in conn.execute(vector_statement)}
+
+        if device_id is not None:
+            seqs = itertools.count(vector.get(device_id, (0, 0, 0))[0] + 1)
+            rows = [row._replace(device=device_id, seq=next(seqs)) if row.device is None else row for row in rows]
+
+        inserted = insert_timer_logs(conn, rows)
+
+        # Fold what was actually inserted into the version vector
+        new_vector = dict(vector)
+        for row in inserted:
+            device, seq = row.device, row.seq
+            max_seq, n_rows, checksum = new_vector.get(device, (0, 0, 0))
+            new_vector[device] = (max(max_seq, seq), n_rows + 1, checksum + seq % seq_checksum_modulus)
+
+        for device, (max_seq, n_rows, checksum) in new_vector.items():
+            if device not in vector:
+                conn.execute(timer_log_vector_table.insert(), dict(device=device, seq=max_seq, n_rows=n_rows, checksum=checksum))
+            elif vector[device] != (max_seq, n_rows, checksum):
+                conn.execute(timer_log_vector_table.update().where(timer_log_vector_table.c.device == device).values(seq=max_seq, n_rows=n_rows, checksum=checksum))
+
+        fold_into_daily_totals(conn, inserted)
+
+    return len(inserted)
+
+
+@metrics.instrument
+def iter_timer_log(since: datetime.datetime | None = None, until: datetime.datetime | None = None, chunk_size: int = 10_000, conn_str: str = default_db_url) -> Iterator[list[LogRow]]:
+    """
+    Log rows with ts after since and before until (either of which can be left open) in ts
+    order, chunk_size at a time. Each chunk is its own query carrying on from the last ts (the
+    primary key) so memory use doesn't grow with the log
+    """
+
+    c = timer_log_table.c
+    engine = get_engine_and_ddl(conn_str=conn_str)
+
+    with engine.connect() as conn:
+        while True:
+            statement = sqlalchemy.select(timer_log_table).order_by(c.ts).limit(chunk_size)
+            if since is not None:
+                statement = statement.where(c.ts > since)
+            if until is not None:
+                statement = statement.where(c.ts < until)
+            chunk = list(map(LogRow._make, conn.execute(statement)))
+            if not chunk:
+                return
+            yield chunk
+            since = chunk[-1].ts
+
+
+@metrics.instrument
+def read_timer_log(since: datetime.datetime | None = None, until: datetime.datetime | None = None, conn_str: str = default_db_url) -> list[LogRow]:
+    return [row for chunk in iter_timer_log(since=since, until=until, conn_str=conn_str) for row in chunk]
+
+
+def select_timer_log_between(since: datetime.date | None = None, until: datetime.date | None = None) -> sqlalchemy.sql.Select:
+    c = timer_log_table.c
+    # (date, ts) is the order of ix_timer_log_date_ts so there's nothing to sort
+    statement = sqlalchemy.select(timer_log_table).order_by(c.date, c.ts)
+    if since is not None:
+        statement = statement.where(c.date >= since)
+    if until is not None:
+        statement = statement.where(c.date <= until)
+    return statement
+
+
+@metrics.instrument
+def read_timer_log_date(date: datetime.date, conn_str: str = default_db_url) -> list[LogRow]:
+    return [row for chunk in iter_timer_log_between(date, date, conn_str=conn_str) for row in chunk]
+
+
+@metrics.instrument
+def iter_timer_log_between(since: datetime.date | None = None, until: datetime.date | None = None, chunk_size: int = 10_000, conn_str: str = default_db_url) -> Iterator[list[LogRow]]:
+    """
+    Log rows dated from since up to and including until (either of which can be left
+    open), in ts order, from one query whose results are streamed chunk_size at a time
+    """
+
+    engine = get_engine_and_ddl(conn_str=conn_str)
+    with engine.connect() as conn:
+        result = conn.execution_options(yield_per=chunk_size).execute(select_timer_log_between(since, until))
+        for chunk in result.partitions():
+            yield list(map(LogRow._make, chunk))
+
+
+@metrics.instrument
 def clear_state(conn_str: str = default_db_url) -> None:
     stmt = sqlalchemy.delete(TimerStateBase)
     with get_session(conn_str=conn_str) as session:
@@ -164,6 +807,7 @@ def clear_state(conn_str: str = default_db_url) -> None:
         session.commit()
 
 
+@metrics.instrument
 def write_state(row: dict[Any], conn_str: str = default_db_url) -> None:
     # Put into pydantic class first so we catch any issues
     stg = TimerStatePydantic(**row)
@@ -174,8 +818,212 @@ def write_state(row: dict[Any], conn_str: str = default_db_url) -> None:
         session.commit()
 
 
+@metrics.instrument
+def replace_state(rows: list[dict[Any]], conn_str: str = default_db_url) -> None:
+    """Replaces the whole state table with rows in one transaction"""
+
+    # Put into pydantic class first so we catch any issues
+    insert_data = [TimerStatePydantic(**row).dict() for row in rows]
+    engine = get_engine_and_ddl(conn_str=conn_str)
+    with engine.begin() as conn:
+        conn.execute(timer_state_table.delete())
+        if insert_data:
+            conn.execute(timer_state_table.insert(), insert_data)
+
+
+@metrics.instrument
 def read_state(conn_str: str = default_db_url) -> list[TimerStateBase]:
     with get_session(conn_str=conn_str) as session:
         statement = sqlalchemy.select(TimerStateBase)
         ret = session.scalars(statement).all()
     return ret
+
+
+###
+# Helpers for sync
+###
+
+
+@metrics.instrument
+def read_timer_log_vector(conn_str: str = default_db_url) -> dict[str, tuple[int, int, int]]:
+    """Version vector as {device: (highest seq, number of rows, checksum of seqs)}"""
+
+    engine = get_engine_and_ddl(conn_str=conn_str)
+    with engine.connect() as conn:
+        ret = {row.device: (row.seq, row.n_rows, row.checksum) for row in conn.execute(sqlalchemy.select(timer_log_vector_table))}
+    return ret
+
+
+@metrics.instrument
+def iter_timer_log_above(device: str, seq: int, chunk_size: int = 10_000, conn_str: str = default_db_url) -> Iterator[list[LogRow]]:
+    """
+    Log rows from device with a seq above seq in seq order, chunk_size at a time. Each chunk
+    is its own short query carrying on from the last seq, using the (device, seq) index, so
+    no read is held open while the rows are written elsewhere
+    """
+
+    c = timer_log_table.c
+    engine = get_engine_and_ddl(conn_str=conn_str)
+
+    while True:
+        statement = sqlalchemy.select(timer_log_table).where(c.device == device, c.seq > seq).order_by(c.seq).limit(chunk_size)
+        with engine.connect() as conn:
+            chunk = list(map(LogRow._make, conn.execute(statement)))
+        if not chunk:
+            return
+        yield chunk
+        seq = chunk[-1].seq
+
+
+@metrics.instrument
+def count_timer_log_above(device: str, seq: int, conn_str: str = default_db_url) -> tuple[int, int]:
+    """Number of log rows from device with a seq above seq, and the checksum of their seqs (as in the version vector)"""
+
+    c = timer_log_table.c
+    checksum = sqlalchemy.func.coalesce(sqlalchemy.func.sum(c.seq % seq_checksum_modulus), 0)
+    statement = sqlalchemy.select(sqlalchemy.func.count(), checksum).where(c.device == device, c.seq > seq)
+    engine = get_engine_and_ddl(conn_str=conn_str)
+    with engine.connect() as conn:
+        ret = tuple(conn.execute(statement).one())
+    return ret
+
+
+@metrics.instrument
+def read_timer_log_fingerprints(device: str | None = None, conn_str: str = default_db_url) -> dict[datetime.date, tuple[int, int, int, int]]:
+    """
+    Cheap fingerprint of each date's log rows, optionally only for rows from device, as
+    {date: (count, min ts, max ts, checksum of ts)} with the timestamps in epoch microseconds
+    """
+
+    c = timer_log_table.c
+    us = epoch_us_sql(c.ts)
+    # Microseconds into the day keeps the sum well away from overflowing
+    checksum = sqlalchemy.func.sum(us % 86_400_000_000)
+    statement = sqlalchemy.select(c.date, sqlalchemy.func.count(), sqlalchemy.func.min(us), sqlalchemy.func.max(us), checksum).group_by(c.date)
+    if device is not None:
+        statement = statement.where(c.device == device)
+
+    engine = get_engine_and_ddl(conn_str=conn_str)
+    with engine.connect() as conn:
+        ret = {row[0]: tuple(row[1:]) for row in conn.execute(statement)}
+    return ret
+
+
+@metrics.instrument
+def read_timer_log_dates(dates: list[datetime.date], device: str | None = None, conn_str: str = default_db_url) -> list[LogRow]:
+    """Log rows for the given dates, optionally only for rows from device"""
+
+    c = timer_log_table.c
+    engine = get_engine_and_ddl(conn_str=conn_str)
+    chunk_size: Final[int] = 500
+    ret = []
+
+    with engine.connect() as conn:
+        # Chunked so the IN list stays a sensible size
+        for i in range(0, len(dates), chunk_size):
+            statement = sqlalchemy.select(timer_log_table).where(c.date.in_(dates[i : i + chunk_size])).order_by(c.ts)
+            if device is not None:
+                statement = statement.where(c.device == device)
+            ret.extend(map(LogRow._make, conn.execute(statement)))
+
+    return ret
+
+
+###
+# Helpers for reports
+###
+
+
+@metrics.instrument
+def read_period_totals(period: str, since: datetime.date | None = None, until: datetime.date | None = None, conn_str: str = default_db_url) -> list[sqlalchemy.engine.Row]:
+    """
+    Seconds and sessions per label per period (day, week or month) from daily_totals,
+    along with each label's share of the period, rank within the period and running total,
+    all worked out in the database so only the aggregated rows come back
+    """
+
+    c = daily_totals_table.c
+    period_start = period_start_sql(c.date, period)
+    totals = sqlalchemy.select(
+        period_start.label("period"),
+        c.label,
+        sqlalchemy.func.sum(c.seconds).label("seconds"),
+        sqlalchemy.func.sum(c.sessions).label("sessions"),
+    ).group_by(period_start, c.label)
+    if since is not None:
+        totals = totals.where(c.date >= since)
+    if until is not None:
+        totals = totals.where(c.date <= until)
+    totals = totals.subquery()
+
+    t = totals.c
+    statement = sqlalchemy.select(
+        t.period,
+        t.label,
+        t.seconds,
+        t.sessions,
+        (t.seconds / sqlalchemy.func.nullif(sqlalchemy.func.sum(t.seconds).over(partition_by=t.period), 0)).label("share"),
+        sqlalchemy.func.rank().over(partition_by=t.period, order_by=t.seconds.desc()).label("rank"),
+        sqlalchemy.func.sum(t.seconds).over(partition_by=t.label, order_by=t.period).label("running_seconds"),
+    ).order_by(t.period, t.seconds.desc(), t.label)
+
+    engine = get_engine_and_ddl(conn_str=conn_str)
+    with engine.connect() as conn:
+        ret = conn.execute(statement).all()
+    return ret
+
+
+###
+# Helpers for rebuilding state from the log
+###
+
+
+@metrics.instrument
+def count_timer_log_until(ts: datetime.datetime, conn_str: str = default_db_url) -> int:
+    """Number of log rows at or before ts"""
+
+    statement = sqlalchemy.select(sqlalchemy.func.count()).where(timer_log_table.c.ts <= ts)
+    engine = get_engine_and_ddl(conn_str=conn_str)
+    with engine.connect() as conn:
+        ret = conn.scalar(statement)
+    return ret
+
+
+@metrics.instrument
+def read_rebuild_checkpoint(conn_str: str = default_db_url) -> tuple[datetime.datetime | None, int, dict[str, tuple[float, datetime.datetime | None]]]:
+    """Checkpoint of the last rebuild as (last ts, number of rows folded in, {label: (elapsed, start ts)})"""
+
+    engine = get_engine_and_ddl(conn_str=conn_str)
+    with engine.connect() as conn:
+        checkpoint = conn.execute(sqlalchemy.select(rebuild_checkpoint_table)).first()
+        totals = {row.label: (row.elapsed, row.start_ts) for row in conn.execute(sqlalchemy.select(rebuild_totals_table))}
+
+    if checkpoint is None:
+        return None, 0, {}
+    return checkpoint.ts, checkpoint.n_rows, totals
+
+
+@metrics.instrument
+def write_rebuild(
+    rows: list[dict[Any]],
+    ts: datetime.datetime | None,
+    n_rows: int,
+    totals: dict[str, tuple[float, datetime.datetime | None]],
+    conn_str: str = default_db_url,
+) -> None:
+    """Replaces the state table with rows and stores the rebuild checkpoint, in one transaction"""
+
+    # Put into pydantic class first so we catch any issues
+    insert_data = [TimerStatePydantic(**row).dict() for row in rows]
+    engine = get_engine_and_ddl(conn_str=conn_str)
+    with engine.begin() as conn:
+        conn.execute(timer_state_table.delete())
+        if insert_data:
+            conn.execute(timer_state_table.insert(), insert_data)
+
+        conn.execute(rebuild_checkpoint_table.delete())
+        conn.execute(rebuild_totals_table.delete())
+        if ts is not None:
+            conn.execute(rebuild_checkpoint_table.insert(), dict(ts=ts, n_rows=n_rows))
+        if totals:
+            conn.execute(rebuild_totals_table.insert(), [dict(label=label, elapsed=elapsed, start_ts=start_ts) for label, (elapsed, start_ts) in totals.items()])
@@ -0,0 +1,125 @@
+"""Export the timer log and the sessions paired from it to Parquet, partitioned by year and month"""
+
+import datetime
+import json
+import pathlib
+import shutil
+import time
+
+import db
+
+from typing import Any, Final
+
+default_export_dir: Final[str] = "export"
+log_dataset: Final[str] = "timer_log"
+sessions_dataset: Final[str] = "sessions"
+# starts still waiting for their stop when the last export finished, as [label, ts] pairs
+running_file: Final[str] = "running.json"
+
+
+def partition_dir(root: pathlib.Path, dataset: str, year: int, month: int) -> pathlib.Path:
+    # Hive style directories so pyarrow/pandas/duckdb can filter on year and month without opening files
+    return root / dataset / f"year={year}" / f"month={month}"
+
+
+def existing_partitions(root: pathlib.Path, dataset: str) -> dict[tuple[int, int], pathlib.Path]:
+    """{(year, month): directory} for the partitions of dataset which have been exported"""
+
+    ret = {}
+    for path in (root / dataset).glob("year=*/month=*"):
+        year, month = path.parent.name.split("=")[1], path.name.split("=")[1]
+        ret[(int(year), int(month))] = path
+    return ret
+
+
+def schemas() -> tuple[Any, Any]:
+    import pyarrow as pa
+
+    ts = pa.timestamp("us", tz="UTC")
+    log_schema = pa.schema([("label", pa.string()), ("state", pa.string()), ("date", pa.date32()), ("ts", ts), ("device", pa.string()), ("seq", pa.int64())])
+    sessions_schema = pa.schema([("label", pa.string()), ("start", ts), ("stop", ts), ("elapsed", pa.float64())])
+    return log_schema, sessions_schema
+
+
+def export(out_dir: str = default_export_dir, full: bool = False, conn_str: str = db.default_db_url) -> tuple[int, int]:
+    """
+    Writes timer_log and sessions datasets under out_dir, one Parquet file per year/month
+    partition (sessions are partitioned by when they started). Unless full is set, months
+    before the latest partition which has already been exported are left alone and the log
+    is only read from the start of that month, which may have been exported part way through.
+    Starts from before then which were still waiting for their stop are picked up from the
+    last run, so their sessions are written once the stop comes. Returns the number of log
+    rows and sessions written
+    """
+
+    # pyarrow (and pandas) are only needed for exports
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    import pandas as pd
+    from pairing import StreamingPairer, event_columns, events_frame
+
+    start = time.perf_counter()
+    root = pathlib.Path(out_dir)
+    log_schema, sessions_schema = schemas()
+
+    latest = None if full else max(existing_partitions(root, log_dataset), default=None)
+    since = None if latest is None else datetime.date(*latest, 1)
+    for dataset in (log_dataset, sessions_dataset):
+        for key, path in existing_partitions(root, dataset).items():
+            if latest is None or key >= latest:
+                shutil.rmtree(path)
+
+    def write(dataset: str, key: tuple[int, int], table: pa.Table) -> None:
+        path = partition_dir(root, dataset, *key)
+        path.mkdir(parents=True, exist_ok=True)
+        # A session can finish after its month has been written, it goes in a file of its own
+        pq.write_table(table, path / f"part-{len(list(path.glob('*.parquet')))}.parquet")
+
+    n_rows, n_sessions = 0, 0
+    month, month_rows = None, []
+    pending_sessions: dict[tuple[int, int], list[pa.Table]] = {}
+
+    def write_month() -> None:
+        nonlocal n_rows
+        if month_rows:
+            # LogRows are in column order, so transposing them gives the columns
+            write(log_dataset, month, pa.table(dict(zip(db.LogRow._fields, map(list, zip(*month_rows)))), schema=log_schema))
+            n_rows += len(month_rows)
+
+    def write_sessions(before: tuple[int, int] | None) -> None:
+        nonlocal n_sessions
+        for key in sorted(pending_sessions):
+            if before is None or key < before:
+                table = pa.concat_tables(pending_sessions.pop(key))
+                write(sessions_dataset, key, table)
+                n_sessions += len(table)
+
+    started = []
+    if since is not None and (root / running_file).exists():
+        # Starts from since on are read again
+        started = [(label, datetime.datetime.fromisoformat(ts)) for label, ts in json.loads((root / running_file).read_text())]
+        started = [(label, ts) for label, ts in started if ts.date() < since]
+    running = pd.DataFrame({"label": [label for label, _ in started], "state": "start", "ts": pd.to_datetime([ts for _, ts in started])}, columns=event_columns)
+    pairer = StreamingPairer(running)
+    for chunk in db.iter_timer_log_between(since=since, conn_str=conn_str):
+        # Rows come in date order so a month is finished with once the next one starts
+        for row in chunk:
+            key = (row.date.year, row.date.month)
+            if key != month:
+                write_month()
+                month, month_rows = key, []
+            month_rows.append(row)
+
+        sessions, _ = pairer.feed(events_frame(chunk))
+        for (year, month_), group in sessions.groupby([sessions.start.dt.year, sessions.start.dt.month]):
+            table = pa.Table.from_pandas(group, schema=sessions_schema, preserve_index=False)
+            pending_sessions.setdefault((int(year), int(month_)), []).append(table)
+        write_sessions(before=month)
+
+    write_month()
+    write_sessions(before=None)
+    root.mkdir(parents=True, exist_ok=True)
+    (root / running_file).write_text(json.dumps([[row.label, row.ts.isoformat()] for row in pairer.running.itertuples()]))
+
+    print(f"Exported {n_rows} log rows and {n_sessions} sessions to {root} in {time.perf_counter() - start:.2f}s")
+    return n_rows, n_sessions
@@ -3,24 +3,37 @@
 import argparse
 import sys
 import datetime
-from app import runapp
-from cal import cal
-from sync import sync
 from typing import Final
 
+# Subsystems (and their dependencies: textual, pandas, sqlalchemy etc) are only
+# imported once we know which flag was used, so startup stays quick
+
 
 def main() -> int:
     def add_arguments(parser: argparse.ArgumentParser) -> None:
         store_true: Final = "store_true"
         parser.add_argument("-a", "--app", help="Run the app!", action=store_true)
         parser.add_argument("-s", "--sync", help="Sync", action=store_true)
+        parser.add_argument("--sync-daemon", help="Keep syncing the log as it is written, until interrupted", action=store_true)
         # const actually means default and default means something else ...
-        parser.add_argument("-c", "--calendar", help="Calendar times", type=str, const=str(datetime.date.today()), nargs="?")
+        parser.add_argument("-c", "--calendar", help="Calendar times for a date or range of dates (YYYY-MM-DD..YYYY-MM-DD)", type=str, const=str(datetime.date.today()), nargs="?")
+        parser.add_argument("-r", "--rebuild", help="Rebuild timer state from the log", action=store_true)
+        parser.add_argument("-e", "--export", help="Export the log and sessions to Parquet under this directory", type=str, const="export", nargs="?")
+        parser.add_argument("--report", help="Totals per label by day, week or month", choices=["day", "week", "month"], const="week", nargs="?")
 
     # Create the root argument parser and add global arguments
     parser = argparse.ArgumentParser(description="TODO")
     group = parser.add_mutually_exclusive_group()
     add_arguments(group)
+    parser.add_argument("--full", help="With --rebuild or --export, go through the whole log rather than carrying on from last time", action="store_true")
+    parser.add_argument("--since", help="With --report, the first date (YYYY-MM-DD) to include", type=datetime.date.fromisoformat)
+    parser.add_argument("--until", help="With --report, the last date (YYYY-MM-DD) to include", type=datetime.date.fromisoformat)
+    parser.add_argument("--format", help="With --report, how to output it", choices=["table", "csv", "json"], default="table")
+    parser.add_argument("--remote", help="With --report, report from the remote database rather than the local one", action="store_true")
+    parser.add_argument("-v", "--verbose", help="With --sync, print every row which is sent", action="store_true")
+    parser.add_argument("--profile", help="Afterwards, print how long db calls, sync phases and statements took as a summary or JSON", choices=["summary", "json"], const="summary", nargs="?")
+    parser.add_argument("--profile-file", help="With --profile, write to this file rather than stdout", type=str)
+    parser.add_argument("--cprofile", help="Run under cProfile and write the stats (for python -m pstats, snakeviz etc) to this file", type=str)
     args: argparse.Namespace = parser.parse_args()
 
     # If run with no arguments mention -h
@@ -29,15 +42,81 @@ def main() -> int:
         print(f"No flags provided, for usage please use:\n\tpython {script_name} -h")
         return 1
 
+    if not (args.profile or args.cprofile):
+        return run(args)
+
+    import metrics
+
+    if args.profile:
+        metrics.enable()
+    if args.cprofile:
+        import cProfile
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        return run(args)
+    finally:
+        if args.cprofile:
+            profiler.disable()
+            profiler.dump_stats(args.cprofile)
+            print(f"cProfile stats written to {args.cprofile}")
+        if args.profile:
+            metrics.disable()
+            if args.profile_file:
+                with open(args.profile_file, "w") as f:
+                    metrics.write(f, fmt=args.profile)
+                print(f"Profile written to {args.profile_file}")
+            else:
+                metrics.write(sys.stdout, fmt=args.profile)
+
+
+def run(args: argparse.Namespace) -> int:
+    """Runs whichever subsystem was asked for"""
+
     if args.app:
+        from app import runapp
+
         return runapp()
 
     if args.sync:
-        sync()
+        from sync import sync
+
+        sync(verbose=args.verbose)
+
+    if args.sync_daemon:
+        import signal
+        import threading
+        from sync import sync_daemon
+
+        stop = threading.Event()
+        # pc.sh stops the daemon with SIGTERM once the app has exited
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+        try:
+            n_to_remote, n_to_local = sync_daemon(stop=stop)
+        except KeyboardInterrupt:
+            return 0
+        print(f"Sync daemon stopped, {n_to_remote} rows synced to remote and {n_to_local} to local")
 
     if args.calendar:
-        date_ = datetime.date(*[int(x) for x in args.calendar.split("-")])
-        cal(date_)
+        from cal import cal, parse_date_range
+
+        cal(*parse_date_range(args.calendar))
+
+    if args.rebuild:
+        from rebuild_state_from_log import rebuild_state
+
+        rebuild_state(full=args.full)
+
+    if args.export:
+        from export import export
+
+        export(args.export, full=args.full)
+
+    if args.report:
+        from report import report
+
+        report(args.report, since=args.since, until=args.until, fmt=args.format, remote=args.remote)
 
     return 0
 
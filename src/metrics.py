@@ -0,0 +1,229 @@
+"""
+Wall time, row counts and per-statement latency for db functions and sync phases, off
+unless enabled (main.py --profile) so there is next to nothing to pay for it otherwise
+"""
+
+import bisect
+import contextlib
+import functools
+import inspect
+import json
+import re
+import threading
+import time
+
+from typing import Any, Callable, Final, Iterator, TextIO
+
+# upper bounds (in milliseconds) of the latency histogram buckets, the last one catches the rest
+latency_buckets_ms: Final[tuple[float, ...]] = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, float("inf"))
+# the verb and (first) table of a statement, so statements are grouped as e.g. "INSERT timer_log"
+statement_pattern: Final[re.Pattern] = re.compile(r"^\s*(\w+).*?\b(?:FROM|INTO|UPDATE|TABLE|ON)\s+\"?(\w+)", re.IGNORECASE | re.DOTALL)
+
+enabled: bool = False
+
+
+class Stat:
+    """Calls, rows and a latency histogram for one function, phase or kind of statement"""
+
+    __slots__ = ("calls", "rows", "seconds", "max_seconds", "buckets")
+
+    def __init__(self):
+        self.calls = 0
+        self.rows = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.buckets = [0] * len(latency_buckets_ms)
+
+    def add(self, seconds: float, rows: int = 0) -> None:
+        self.calls += 1
+        self.rows += rows
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        self.buckets[bisect.bisect_left(latency_buckets_ms, seconds * 1000)] += 1
+
+    def percentile_ms(self, fraction: float) -> float:
+        """Upper bound of the bucket the fraction'th call falls in"""
+
+        target = fraction * self.calls
+        seen = 0
+        for bound, count in zip(latency_buckets_ms, self.buckets):
+            seen += count
+            if seen >= target and count:
+                return min(bound, self.max_seconds * 1000)
+        return self.max_seconds * 1000
+
+    def to_dict(self) -> dict[str, Any]:
+        return dict(
+            calls=self.calls,
+            rows=self.rows,
+            seconds=self.seconds,
+            rows_per_sec=self.rows / self.seconds if self.seconds else 0.0,
+            max_ms=self.max_seconds * 1000,
+            p50_ms=self.percentile_ms(0.5),
+            p95_ms=self.percentile_ms(0.95),
+            histogram_ms={str(bound): count for bound, count in zip(latency_buckets_ms, self.buckets) if count},
+        )
+
+
+# {kind: {name: Stat}}, kinds being "function", "phase" and "statement"
+stats: dict[str, dict[str, Stat]] = {}
+lock = threading.Lock()
+
+
+def record(kind: str, name: str, seconds: float, rows: int = 0) -> None:
+    # Sync reads and writes both sides at the same time
+    with lock:
+        stats.setdefault(kind, {}).setdefault(name, Stat()).add(seconds, rows)
+
+
+def count_rows(value: Any) -> int:
+    """Rows in what a db function returned, a count, a list of rows or a chunk of them"""
+
+    if isinstance(value, bool) or value is None:
+        return 0
+    if isinstance(value, int):
+        return value
+    if isinstance(value, (list, dict)):
+        return len(value)
+    return 1
+
+
+def instrument(fn: Callable) -> Callable:
+    """
+    Records each call to fn while metrics are enabled. Generators are timed for as long as
+    they are being iterated over (not while the caller deals with what they yield) and their
+    rows are what they yield
+    """
+
+    name = fn.__name__
+
+    if inspect.isgeneratorfunction(fn):
+
+        @functools.wraps(fn)
+        def wrapped_generator(*args, **kwargs):
+            if not enabled:
+                yield from fn(*args, **kwargs)
+                return
+            seconds, rows = 0.0, 0
+            start = time.perf_counter()
+            try:
+                for item in fn(*args, **kwargs):
+                    seconds += time.perf_counter() - start
+                    rows += count_rows(item)
+                    yield item
+                    start = time.perf_counter()
+                seconds += time.perf_counter() - start
+            finally:
+                record("function", name, seconds, rows)
+
+        return wrapped_generator
+
+    @functools.wraps(fn)
+    def wrapped(*args, **kwargs):
+        if not enabled:
+            return fn(*args, **kwargs)
+        start = time.perf_counter()
+        ret = fn(*args, **kwargs)
+        record("function", name, time.perf_counter() - start, count_rows(ret))
+        return ret
+
+    return wrapped
+
+
+class Phase:
+    """What a phase reports once it is finished, set rows while it runs"""
+
+    __slots__ = ("rows",)
+
+    def __init__(self):
+        self.rows = 0
+
+
+@contextlib.contextmanager
+def phase(name: str) -> Iterator[Phase]:
+    """Times the block as one phase of something bigger, e.g. a sync"""
+
+    ret = Phase()
+    start = time.perf_counter()
+    try:
+        yield ret
+    finally:
+        if enabled:
+            record("phase", name, time.perf_counter() - start, ret.rows)
+
+
+def statement_name(statement: str) -> str:
+    words = statement.split()
+    if words[:1] == ["COPY"] and len(words) > 1:
+        # COPY table FROM STDIN, the table comes first
+        return f"COPY {words[1]}"
+    match = statement_pattern.match(statement)
+    if match is None:
+        return " ".join(words[:1]).upper()
+    return f"{match.group(1).upper()} {match.group(2)}"
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    conn.info.setdefault("metrics_start", []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    seconds = time.perf_counter() - conn.info["metrics_start"].pop()
+    rows = len(parameters) if executemany else max(cursor.rowcount, 0)
+    record("statement", statement_name(statement), seconds, rows)
+
+
+def enable() -> None:
+    """Starts recording, statements are timed for every engine including ones already created"""
+
+    global enabled
+    import sqlalchemy
+
+    if not enabled:
+        sqlalchemy.event.listen(sqlalchemy.engine.Engine, "before_cursor_execute", before_cursor_execute)
+        sqlalchemy.event.listen(sqlalchemy.engine.Engine, "after_cursor_execute", after_cursor_execute)
+    enabled = True
+
+
+def disable() -> None:
+    global enabled
+    import sqlalchemy
+
+    if enabled:
+        sqlalchemy.event.remove(sqlalchemy.engine.Engine, "before_cursor_execute", before_cursor_execute)
+        sqlalchemy.event.remove(sqlalchemy.engine.Engine, "after_cursor_execute", after_cursor_execute)
+    enabled = False
+
+
+def reset() -> None:
+    with lock:
+        stats.clear()
+
+
+def to_dict() -> dict[str, dict[str, dict[str, Any]]]:
+    with lock:
+        return {kind: {name: stat.to_dict() for name, stat in sorted(by_name.items())} for kind, by_name in stats.items()}
+
+
+def summary() -> str:
+    """A table for each kind of stat, slowest first"""
+
+    from tabulate import tabulate
+
+    headers = ["name", "calls", "rows", "seconds", "rows/sec", "p50 ms", "p95 ms", "max ms"]
+    tables = []
+    for kind, by_name in to_dict().items():
+        table = [
+            (name, s["calls"], s["rows"], f"{s['seconds']:.3f}", f"{s['rows_per_sec']:,.0f}", f"{s['p50_ms']:.2f}", f"{s['p95_ms']:.2f}", f"{s['max_ms']:.2f}")
+            for name, s in sorted(by_name.items(), key=lambda item: -item[1]["seconds"])
+        ]
+        tables.append(f"{kind}\n{tabulate(table, headers=headers)}")
+    return "\n\n".join(tables) if tables else "Nothing was recorded"
+
+
+def write(out: TextIO, fmt: str = "summary") -> None:
+    if fmt == "json":
+        json.dump(to_dict(), out, indent=2)
+        print(file=out)
+    else:
+        print(summary(), file=out)
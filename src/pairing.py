@@ -0,0 +1,81 @@
+"""Pairs start and stop events from the log into sessions, for any number of timers running at once"""
+
+import numpy as np
+import pandas as pd
+
+from typing import Any, Final, Iterable
+
+event_columns: Final[list[str]] = ["label", "state", "ts"]
+
+
+def events_frame(rows: Iterable[Any]) -> pd.DataFrame:
+    """DataFrame of label, state and ts from log rows (Core rows or TimerLogBase objects)"""
+
+    rows = list(rows)
+    return pd.DataFrame(
+        {
+            "label": [row.label for row in rows],
+            "state": [row.state for row in rows],
+            "ts": pd.to_datetime([row.ts for row in rows]),
+        },
+        columns=event_columns,
+    )
+
+
+def pair_events(events: pd.DataFrame) -> tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    """
+    Pairs each start with a stop directly after it for the same label, whatever the order
+    of events across labels. Returns (sessions, orphans, running) where sessions has label,
+    start, stop and elapsed (seconds), orphans has starts followed by something other than
+    a stop, and running has starts which are the last event for their label
+    """
+
+    labels = events["label"].to_numpy()
+    states = events["state"].to_numpy()
+    ts = events["ts"].to_numpy(dtype="datetime64[ns]")
+
+    # Group by label, then ts within each label
+    codes, _ = pd.factorize(labels)
+    order = np.lexsort((ts, codes))
+    codes, states = codes[order], states[order]
+
+    is_start = states == "start"
+    same_label_as_next = np.zeros(len(codes), dtype=bool)
+    same_label_as_next[:-1] = codes[:-1] == codes[1:]
+    stop_next = np.zeros(len(codes), dtype=bool)
+    stop_next[:-1] = states[1:] == "stop"
+
+    paired = is_start & same_label_as_next & stop_next
+    start_idx = order[paired]
+    stop_idx = order[np.roll(paired, 1)]
+
+    def take(column: str, idx: np.ndarray) -> pd.Series:
+        return events[column].iloc[idx].reset_index(drop=True)
+
+    sessions = pd.DataFrame({"label": take("label", start_idx), "start": take("ts", start_idx), "stop": take("ts", stop_idx)})
+    sessions["elapsed"] = (sessions["stop"] - sessions["start"]).dt.total_seconds()
+    sessions = sessions.sort_values("start", kind="stable", ignore_index=True)
+
+    unpaired = is_start & ~paired
+    orphans = events.iloc[order[unpaired & same_label_as_next]].reset_index(drop=True)
+    running = events.iloc[order[unpaired & ~same_label_as_next]].reset_index(drop=True)
+
+    return sessions, orphans, running
+
+
+class StreamingPairer:
+    """
+    Pairs events fed in ts order a chunk at a time. Starts which are the last event for
+    their label in a chunk are carried over so they can be paired with a stop in a later one
+    """
+
+    def __init__(self, running: pd.DataFrame | None = None):
+        self.running = running if running is not None else pd.DataFrame(columns=event_columns)
+
+    def feed(self, events: pd.DataFrame) -> tuple[pd.DataFrame, pd.DataFrame]:
+        """Returns (sessions, orphans) completed by events"""
+
+        if len(self.running):
+            events = pd.concat([self.running, events[event_columns]], ignore_index=True)
+        sessions, orphans, self.running = pair_events(events)
+        return sessions, orphans
@@ -1,42 +1,80 @@
-import pandas as pd
+"""Rebuild timer_state from the timer log"""
 
 import db
 import datetime
-from common import no_tz
+import time
+import pandas as pd
+
+from pairing import StreamingPairer, event_columns, events_frame
+
+from typing import Final
+
+chunk_size: Final[int] = 10_000
+
+
+class RunningTotals:
+    """Elapsed seconds for each label, folded in from chunks of log rows in ts order"""
+
+    def __init__(self, totals: dict[str, tuple[float, datetime.datetime | None]] | None = None):
+        totals = totals or {}
+        self.elapsed: dict[str, float] = {label: elapsed for label, (elapsed, _) in totals.items()}
+        # starts for labels which are running, to be paired with a stop in a later chunk
+        started = [(label, start_ts) for label, (_, start_ts) in totals.items() if start_ts is not None]
+        running = pd.DataFrame({"label": [label for label, _ in started], "state": "start", "ts": pd.to_datetime([ts for _, ts in started])}, columns=event_columns)
+        self.pairer = StreamingPairer(running)
+
+    def fold(self, rows: list) -> None:
+        events = events_frame(rows)
+        sessions, _ = self.pairer.feed(events)
+
+        # A delete means the timer was removed in the app, so it isn't part of the state
+        # any more unless it is started again
+        last_delete = events[events.state == "delete"].groupby("label")["ts"].max()
+        for label in last_delete.index:
+            self.elapsed.pop(label, None)
+        sessions = sessions[~(sessions.start < sessions.label.map(last_delete))]
+        starts = events[(events.state == "start") & ~(events.ts < events.label.map(last_delete))]
 
-from typing import Any
+        for label in starts.label.unique():
+            self.elapsed.setdefault(label, 0.0)
+        for label, seconds in sessions.groupby("label")["elapsed"].sum().items():
+            self.elapsed[label] = self.elapsed.get(label, 0.0) + float(seconds)
 
+    def totals(self) -> dict[str, tuple[float, datetime.datetime | None]]:
+        started = {r.label: r.ts.to_pydatetime() for r in self.pairer.running.itertuples()}
+        return {label: (elapsed, started.get(label)) for label, elapsed in self.elapsed.items()}
 
-rows = db.read_timer_log()
 
+def rebuild(full: bool = False, conn_str: str = db.default_db_url) -> dict[str, float]:
+    """
+    Rebuilds timer_state from the log, carrying on from the checkpoint of the last rebuild
+    unless full is set or rows have since turned up from before it (e.g. from a sync)
+    """
 
-def parse_rows() -> list[dict[str, Any]]:
-    l = []
+    since, n_rows, totals = db.read_rebuild_checkpoint(conn_str=conn_str)
+    if full or (since is not None and db.count_timer_log_until(since, conn_str=conn_str) != n_rows):
+        since, n_rows, totals = None, 0, {}
 
-    for start, stop in zip(rows[::2], rows[1::2]):
-        assert start.label == stop.label
-        assert start.state == "start"
-        assert stop.state == "stop"
+    running = RunningTotals(totals)
+    for chunk in db.iter_timer_log(since=since, chunk_size=chunk_size, conn_str=conn_str):
+        running.fold(chunk)
+        since = chunk[-1].ts
+        n_rows += len(chunk)
 
-        l.append(
-            dict(
-                label=start.label,
-                start=start.ts,
-                stop=stop.ts,
-            )
-        )
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+    rows = [dict(label=label, elapsed=elapsed, ts=now) for label, elapsed in running.elapsed.items()]
+    db.write_rebuild(rows, since, n_rows, running.totals(), conn_str=conn_str)
 
-    return l
+    return running.elapsed
 
 
-# Step 2: write a calendar file for each
-df = pd.DataFrame(parse_rows())
-df["elapsed"] = (df.stop - df.start).dt.total_seconds()
-df_gb = df[["label", "elapsed"]].groupby("label").sum().reset_index()
-print(df_gb)
+def rebuild_state(full: bool = False, conn_str: str = db.default_db_url) -> None:
+    start = time.perf_counter()
+    elapsed = rebuild(full=full, conn_str=conn_str)
+    for label, seconds in sorted(elapsed.items()):
+        print(f"{label}: {datetime.timedelta(seconds=round(seconds))}")
+    print(f"Rebuilt state for {len(elapsed)} timers in {time.perf_counter() - start:.2f}s")
 
-now = no_tz(datetime.datetime.now(tz=datetime.timezone.utc))
 
-delete_ = "delete from timer_state;"
-s = "\n".join([f"""insert into timer_state (label, elapsed, ts) values ('{r.label}', {r.elapsed}, '{now}');""" for _, r in df_gb.iterrows()])
-print(delete_, s, sep="\n")
+if __name__ == "__main__":
+    rebuild_state()
@@ -0,0 +1,58 @@
+"""Totals per label by day, week or month, aggregated in the database"""
+
+import csv
+import datetime
+import json
+import sys
+
+import db
+
+from typing import Any, Final, TextIO
+
+formats: Final[tuple[str, ...]] = ("table", "csv", "json")
+columns: Final[list[str]] = ["period", "label", "seconds", "sessions", "share", "rank", "running_seconds"]
+
+
+def to_dicts(rows: list[Any]) -> list[dict[str, Any]]:
+    return [{column: (value.isoformat() if isinstance(value, datetime.date) else value) for column, value in zip(columns, row)} for row in rows]
+
+
+def hms(seconds: float) -> str:
+    return str(datetime.timedelta(seconds=round(seconds)))
+
+
+def write_report(rows: list[Any], fmt: str = "table", out: TextIO = sys.stdout) -> None:
+    if fmt == "table":
+        from tabulate import tabulate
+
+        table = [(r.period, r.label, hms(r.seconds), r.sessions, f"{r.share or 0:.0%}", r.rank, hms(r.running_seconds)) for r in rows]
+        print(tabulate(table, headers=["period", "label", "time", "sessions", "share", "rank", "running total"]), file=out)
+    elif fmt == "csv":
+        writer = csv.DictWriter(out, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(to_dicts(rows))
+    elif fmt == "json":
+        json.dump(to_dicts(rows), out, indent=2)
+        print(file=out)
+    else:
+        raise Exception(f"Format must be one of {formats}, not {fmt}")
+
+
+def report(
+    period: str,
+    since: datetime.date | None = None,
+    until: datetime.date | None = None,
+    fmt: str = "table",
+    remote: bool = False,
+    conn_str: str = db.default_db_url,
+) -> None:
+    if remote:
+        from sync import config_to_conn_str, load_config
+
+        conn_str = config_to_conn_str(config=load_config())
+
+    rows = db.read_period_totals(period, since=since, until=until, conn_str=conn_str)
+    if not rows and fmt == "table":
+        print("No totals to report")
+        return
+    write_report(rows, fmt=fmt)
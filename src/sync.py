@@ -1,14 +1,19 @@
 import tomllib
 import pathlib
 import datetime
+import functools
+import time
+import threading
+import concurrent.futures
 
 import db
+import metrics
 import sqlalchemy
 from rich import print as pprint
 
 from common import utc_tz
 
-from typing import Final, Any
+from typing import Final, Any, Callable
 
 default_file_name: Final[str] = "creds.toml"
 username: Final[str] = "username"
@@ -16,6 +21,19 @@ password: Final[str] = "password"
 host: Final[str] = "host"
 database: Final[str] = "database"
 
+# prefixes for rows sent to remote/local
+to_remote_symbol: Final[str] = ">"
+to_local_symbol: Final[str] = "<"
+
+# seconds between looks at the local log's version vector, which is all an idle sync daemon does
+default_poll_interval: Final[float] = 2.0
+# seconds to let a burst of writes settle so they go across in one sync
+default_coalesce: Final[float] = 1.0
+# seconds between syncs which happen regardless, to pull what other devices have pushed
+default_pull_interval: Final[float] = 60.0
+# longest wait between attempts while the remote can't be reached
+default_max_backoff: Final[float] = 300.0
+
 
 # Load the configuration file
 def load_config(file_name: str = default_file_name) -> dict[str, Any]:
@@ -58,10 +76,6 @@ def config_to_conn_str(config: dict[str, Any]) -> sqlalchemy.engine.URL:
     )
 
 
-def row_to_dict(row: db.TimerLogBase) -> dict[str, Any]:
-    return dict(label=row.label, state=row.state, date=row.date, ts=row.ts)
-
-
 def get_local_remote_conn_str() -> tuple[str, str]:
     local_conn_str = db.default_db_url
     remote_conn_str = config_to_conn_str(config=load_config())
@@ -69,79 +83,281 @@ def get_local_remote_conn_str() -> tuple[str, str]:
     return local_conn_str, remote_conn_str
 
 
-def get_most_recent_state_timestamps(local_conn_str: str, remote_conn_str: str) -> tuple[datetime.datetime, datetime.datetime]:
-    local_conn_str, remote_conn_str = get_local_remote_conn_str()
-    old = utc_tz(datetime.datetime(1900, 1, 1))
-    max_local, max_remote = old, old
+def concurrently(*calls: Callable[[], Any]) -> list[Any]:
+    """Runs the calls at the same time on a thread pool, returns their results in order"""
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(calls)) as pool:
+        futures = [pool.submit(call) for call in calls]
+        return [future.result() for future in futures]
+
 
-    local_states = db.read_state(conn_str=local_conn_str)
-    remote_states = db.read_state(conn_str=remote_conn_str)
+def most_recent_state_timestamp(states: list[db.TimerStateBase]) -> datetime.datetime:
+    max_ts = utc_tz(datetime.datetime(1900, 1, 1))
 
     # Loop through to get the latest
-    for state in local_states:
+    for state in states:
         ts = utc_tz(state.ts)
-        if ts > max_local:
-            max_local = ts
+        if ts > max_ts:
+            max_ts = ts
 
-    for state in remote_states:
-        ts = utc_tz(state.ts)
-        if ts > max_remote:
-            max_remote = ts
+    return max_ts
 
-    return max_local, max_remote
 
+def get_most_recent_state_timestamps(local_conn_str: str, remote_conn_str: str) -> tuple[datetime.datetime, datetime.datetime]:
+    local_states, remote_states = concurrently(
+        functools.partial(db.read_state, conn_str=local_conn_str),
+        functools.partial(db.read_state, conn_str=remote_conn_str),
+    )
 
-def sync() -> None:
-    local_symbol: Final[str] = "<"
-    remote_symbol: Final[str] = ">"
+    return most_recent_state_timestamp(local_states), most_recent_state_timestamp(remote_states)
 
-    local_conn_str, remote_conn_str = get_local_remote_conn_str()
-    remote_engine = db.get_engine_and_ddl(conn_str=remote_conn_str)
-    local_engine = db.get_engine_and_ddl(conn_str=local_conn_str)
 
-    print(f"Local: {local_engine}")
-    print(f"Remote: {remote_engine}")
+def diff_device(device: str, local_conn_str: str, remote_conn_str: str) -> tuple[list[db.LogRow], list[db.LogRow]]:
+    """
+    Compares log rows from device on both sides, returns (rows missing remotely, rows missing locally).
+    Per date fingerprints are compared first so only rows for the dates which differ are read
+    """
+
+    local_fingerprints, remote_fingerprints = concurrently(
+        functools.partial(db.read_timer_log_fingerprints, device, conn_str=local_conn_str),
+        functools.partial(db.read_timer_log_fingerprints, device, conn_str=remote_conn_str),
+    )
+    dates = sorted(date for date in local_fingerprints.keys() | remote_fingerprints.keys() if local_fingerprints.get(date) != remote_fingerprints.get(date))
+
+    if not dates:
+        return [], []
+
+    local_rows, remote_rows = concurrently(
+        functools.partial(db.read_timer_log_dates, dates, device, conn_str=local_conn_str),
+        functools.partial(db.read_timer_log_dates, dates, device, conn_str=remote_conn_str),
+    )
+    local_by_ts = {utc_tz(row.ts): row for row in local_rows}
+    remote_by_ts = {utc_tz(row.ts): row for row in remote_rows}
+
+    to_remote = [row for ts, row in local_by_ts.items() if ts not in remote_by_ts]
+    to_local = [row for ts, row in remote_by_ts.items() if ts not in local_by_ts]
+
+    return to_remote, to_local
+
+
+def count_above(vector: dict[str, tuple[int, int, int]], other_vector: dict[str, tuple[int, int, int]], conn_str: str) -> dict[str, tuple[int, int]]:
+    """(Number of rows, checksum of their seqs) for each device where vector is ahead of other_vector"""
+
+    ret = {}
+    for device, (seq, _, _) in vector.items():
+        other_seq = other_vector.get(device, (0, 0, 0))[0]
+        if seq > other_seq:
+            ret[device] = db.count_timer_log_above(device, other_seq, conn_str=conn_str)
+    return ret
+
+
+def copy_above(seqs: dict[str, int], from_conn_str: str, to_conn_str: str, symbol: str, report: Callable[[str, db.LogRow], None] | None = None) -> int:
+    """Copies rows for each device with a seq above seqs[device] a chunk at a time, returns the number written"""
+
+    n_written = 0
+    for device, seq in seqs.items():
+        for chunk in db.iter_timer_log_above(device, seq, conn_str=from_conn_str):
+            n_written += db.write_log_rows(chunk, conn_str=to_conn_str)
+            if report is not None:
+                for row in chunk:
+                    report(symbol, row)
+    return n_written
+
+
+def sync_log(local_conn_str: str, remote_conn_str: str, report: Callable[[str, db.LogRow], None] | None = None) -> tuple[int, int]:
+    """
+    Syncs the log using the version vectors, so only rows which the other side hasn't seen are read.
+    Rows are copied a chunk at a time, pushing and pulling at the same time, so memory use doesn't
+    grow with how far behind either side is. report is called with (to_remote_symbol or
+    to_local_symbol, row) for each row sent. Returns (rows written remotely, rows written locally)
+    """
+
+    with metrics.phase("sync_log.read_vectors") as phase:
+        local_vector, remote_vector = concurrently(
+            functools.partial(db.read_timer_log_vector, conn_str=local_conn_str),
+            functools.partial(db.read_timer_log_vector, conn_str=remote_conn_str),
+        )
+        phase.rows = len(local_vector) + len(remote_vector)
+
+    if local_vector == remote_vector:
+        # Both sides have seen the same from every device
+        return 0, 0
+
+    with metrics.phase("sync_log.count") as phase:
+        n_push, n_pull = concurrently(
+            functools.partial(count_above, local_vector, remote_vector, conn_str=local_conn_str),
+            functools.partial(count_above, remote_vector, local_vector, conn_str=remote_conn_str),
+        )
+        phase.rows = sum(n for n, _ in n_push.values()) + sum(n for n, _ in n_pull.values())
+
+    push_seqs, pull_seqs, to_remote, to_local = {}, {}, [], []
+
+    with metrics.phase("sync_log.diff") as phase:
+        for device in sorted(local_vector.keys() | remote_vector.keys()):
+            local_seq, local_n, local_checksum = local_vector.get(device, (0, 0, 0))
+            remote_seq, remote_n, remote_checksum = remote_vector.get(device, (0, 0, 0))
+            pull_n, pull_checksum = n_pull.get(device, (0, 0))
+            push_n, push_checksum = n_push.get(device, (0, 0))
+
+            # Seqs are dense for rows stamped by write_timer_logs, so the above is everything; legacy
+            # rows (or anything else with gaps) can also be missing below the other side's highest seq,
+            # in which case the two sides won't come out the same once the above is copied
+            if (local_n + pull_n, local_checksum + pull_checksum) != (remote_n + push_n, remote_checksum + push_checksum):
+                device_push, device_pull = diff_device(device, local_conn_str, remote_conn_str)
+                to_remote.extend(device_push)
+                to_local.extend(device_pull)
+                continue
+
+            if device in n_push:
+                push_seqs[device] = remote_seq
+            if device in n_pull:
+                pull_seqs[device] = local_seq
+        phase.rows = len(to_remote) + len(to_local)
+
+    def push() -> int:
+        n_written = copy_above(push_seqs, local_conn_str, remote_conn_str, to_remote_symbol, report)
+        return n_written + db.write_log_rows(to_remote, conn_str=remote_conn_str)
+
+    def pull() -> int:
+        n_written = copy_above(pull_seqs, remote_conn_str, local_conn_str, to_local_symbol, report)
+        return n_written + db.write_log_rows(to_local, conn_str=local_conn_str)
+
+    if report is not None:
+        for row in to_remote:
+            report(to_remote_symbol, row)
+        for row in to_local:
+            report(to_local_symbol, row)
+
+    with metrics.phase("sync_log.copy") as phase:
+        n_to_remote, n_to_local = concurrently(push, pull)
+        phase.rows = n_to_remote + n_to_local
+    return n_to_remote, n_to_local
+
+
+def sync_state(local_conn_str: str, remote_conn_str: str, verbose: bool = False) -> None:
+    """Overwrites the older of the two state tables with the newer one, printing each row written if verbose"""
 
-    # State
     # Compare timestamps to see which is more recent
-    local_ts, remote_ts = get_most_recent_state_timestamps(local_conn_str, remote_conn_str)
+    local_states, remote_states = concurrently(
+        functools.partial(db.read_state, conn_str=local_conn_str),
+        functools.partial(db.read_state, conn_str=remote_conn_str),
+    )
+    local_ts, remote_ts = most_recent_state_timestamp(local_states), most_recent_state_timestamp(remote_states)
 
     if remote_ts > local_ts:
         # Get state from remote to local (local is overwritten)
-        list_of_state = db.read_state(conn_str=remote_conn_str)
         db.clear_state(conn_str=local_conn_str)
         print(f"state table cleared (locally)")
-        for row in list_of_state:
+        for row in remote_states:
             db.write_state(dict(label=row.label, elapsed=row.elapsed, ts=row.ts), conn_str=local_conn_str)
-            print(f"{local_symbol} {row} written (locally)")
+            if verbose:
+                print(f"{to_local_symbol} {row} written (locally)")
+        print(f"{len(remote_states)} state rows written (locally)")
     elif local_ts > remote_ts:
         # Send state from local to remote (remote is overwritten)
-        list_of_state = db.read_state(conn_str=local_conn_str)
         db.clear_state(conn_str=remote_conn_str)
         print(f"state table cleared (remotely)")
-        for row in list_of_state:
+        for row in local_states:
             db.write_state(dict(label=row.label, elapsed=row.elapsed, ts=row.ts), conn_str=remote_conn_str)
-            print(f"{remote_symbol} {row} written (remotely)")
+            if verbose:
+                print(f"{to_remote_symbol} {row} written (remotely)")
+        print(f"{len(local_states)} state rows written (remotely)")
     else:
         pprint("Looks like state already synced, not doing anything :grinning_face:")
 
+
+def sync(local_conn_str: str | None = None, remote_conn_str: str | None = None, verbose: bool = False) -> None:
+    """Syncs state then the log, only printing each row sent if verbose since that is slow for big syncs"""
+
+    start = time.perf_counter()
+
+    if local_conn_str is None or remote_conn_str is None:
+        local_conn_str, remote_conn_str = get_local_remote_conn_str()
+
+    # Connecting (and any migrations) to each side can happen at the same time
+    with metrics.phase("sync.connect"):
+        local_engine, remote_engine = concurrently(
+            functools.partial(db.get_engine_and_ddl, conn_str=local_conn_str),
+            functools.partial(db.get_engine_and_ddl, conn_str=remote_conn_str),
+        )
+
+    print(f"Local: {local_engine}")
+    print(f"Remote: {remote_engine}")
+
+    # State
+    with metrics.phase("sync.state"):
+        sync_state(local_conn_str, remote_conn_str, verbose=verbose)
+
     # Log
-    local_dict = {utc_tz(row.ts): row_to_dict(row) for row in db.read_timer_log(conn_str=local_conn_str)}
-    remote_dict = {utc_tz(row.ts): row_to_dict(row) for row in db.read_timer_log(conn_str=remote_conn_str)}
-
-    # Anything in local not in remote gets written to remote
-    for ts in local_dict.keys():
-        if ts not in remote_dict.keys():
-            row_dict = local_dict[ts]
-            db.write_timer_log(row_dict, conn_str=remote_conn_str)
-            print(f"{remote_symbol} {row_dict} written")
-
-    # Anything in remote not in local gets written to local
-    for ts in remote_dict.keys():
-        if ts not in local_dict.keys():
-            row_dict = remote_dict[ts]
-            db.write_timer_log(row_dict, conn_str=local_conn_str)
-            print(f"{local_symbol} {row_dict} written")
+    report = (lambda symbol, row: print(f"{symbol} {row} written")) if verbose else None
+    with metrics.phase("sync.log") as phase:
+        n_to_remote, n_to_local = sync_log(local_conn_str, remote_conn_str, report=report)
+        phase.rows = n_to_remote + n_to_local
+
+    print(f"Synced {n_to_remote} rows to remote, {n_to_local} rows to local in {time.perf_counter() - start:.2f}s")
+
+
+def backoff(failures: int, base: float, maximum: float) -> float:
+    """Seconds to wait after failures attempts in a row have failed, doubling each time"""
+
+    return min(maximum, base * 2 ** (failures - 1))
+
+
+def sync_daemon(
+    local_conn_str: str | None = None,
+    remote_conn_str: str | None = None,
+    stop: threading.Event | None = None,
+    poll_interval: float = default_poll_interval,
+    coalesce: float = default_coalesce,
+    pull_interval: float = default_pull_interval,
+    max_backoff: float = default_max_backoff,
+) -> tuple[int, int]:
+    """
+    Syncs the log shortly after rows are written locally, and every pull_interval regardless,
+    until stop is set. Polling only reads the local version vector, so the remote isn't touched
+    while there is nothing to push. After each failure in a row (e.g. the remote can't be
+    reached) it waits twice as long before trying again, up to max_backoff.
+    Returns the total (rows written remotely, rows written locally)
+    """
+
+    if local_conn_str is None or remote_conn_str is None:
+        local_conn_str, remote_conn_str = get_local_remote_conn_str()
+    stop = stop or threading.Event()
+
+    n_to_remote, n_to_local = 0, 0
+    # local vector as of the start of the last sync which worked
+    synced_vector = None
+    last_sync = -float("inf")
+    failures = 0
+
+    while not stop.is_set():
+        wait = poll_interval
+        try:
+            vector = db.read_timer_log_vector(conn_str=local_conn_str)
+            if vector != synced_vector or time.monotonic() - last_sync >= pull_interval:
+                if synced_vector is not None and vector != synced_vector:
+                    # The app writes a batch a second, so a burst of activity goes in one sync
+                    if stop.wait(coalesce):
+                        break
+                    vector = db.read_timer_log_vector(conn_str=local_conn_str)
+
+                with metrics.phase("sync_daemon.sync") as phase:
+                    pushed, pulled = sync_log(local_conn_str, remote_conn_str)
+                    phase.rows = pushed + pulled
+                # Rows pulled change the local vector, so the next poll syncs again, which
+                # is cheap as the vectors then match
+                synced_vector, last_sync = vector, time.monotonic()
+                n_to_remote, n_to_local = n_to_remote + pushed, n_to_local + pulled
+                if pushed or pulled:
+                    print(f"{datetime.datetime.now():%X} Synced {pushed} rows to remote, {pulled} rows to local")
+            failures = 0
+        except Exception as e:
+            failures += 1
+            wait = backoff(failures, poll_interval, max_backoff)
+            print(f"{datetime.datetime.now():%X} Sync failed ({e.__class__.__name__}), trying again in {wait:.1f}s")
+        stop.wait(wait)
+
+    return n_to_remote, n_to_local
 
 
 if __name__ == "__main__":
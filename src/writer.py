@@ -0,0 +1,231 @@
+"""Write-behind of the app's log and state, so button presses never wait on the db"""
+
+import array
+import datetime
+import enum
+import threading
+import time
+
+import db
+from common import epoch_us
+
+from typing import Any, Final
+
+# seconds between flushes
+default_interval: Final[float] = 1.0
+# log events waiting to be written before more are dropped, which only happens if the db
+# has been unreachable for a long time
+default_max_pending: Final[int] = 100_000
+# log rows written per transaction
+max_batch: Final[int] = 5_000
+# seconds between checkpoints of the db's write-ahead log, see db.checkpoint
+checkpoint_interval: Final[float] = 300.0
+
+epoch: Final[datetime.datetime] = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+class State(enum.IntEnum):
+    """States in the log, stored as a byte each in an EventBuffer"""
+
+    start = 0
+    stop = 1
+    delete = 2
+
+
+class EventBuffer:
+    """
+    Log events for one label waiting to be written: timestamps as epoch microseconds and
+    states as State values in arrays, with the label stored once. Appending is O(1) and
+    draining hands the arrays over whole rather than copying them. Events which fail to be
+    written are put back, so they stay in this compact form until they are retried
+    """
+
+    __slots__ = ("label", "ts", "states", "lock", "room", "n_dropped")
+
+    def __init__(self, label: str, room: threading.Semaphore) -> None:
+        self.label = label
+        self.ts = array.array("q")
+        self.states = array.array("b")
+        # the app appends while the writer's thread drains
+        self.lock = threading.Lock()
+        # shared by the writer's buffers, one for each event any of them can still take
+        self.room = room
+        # events refused as there wasn't room for them
+        self.n_dropped = 0
+
+    def __len__(self) -> int:
+        return len(self.ts)
+
+    def append(self, state: State, ts_us: int) -> bool:
+        """Returns False (rather than wait on the app's thread) if the event was dropped for want of room"""
+
+        if not self.room.acquire(blocking=False):
+            self.n_dropped += 1
+            return False
+        with self.lock:
+            self.ts.append(ts_us)
+            self.states.append(state)
+        return True
+
+    def drain(self) -> tuple[array.array, array.array]:
+        """Takes everything appended so far as (timestamps, states)"""
+
+        with self.lock:
+            ts, states = self.ts, self.states
+            self.ts, self.states = array.array("q"), array.array("b")
+        return ts, states
+
+    def put_back(self, ts: array.array, states: array.array) -> None:
+        """Returns drained events which weren't written, ahead of anything appended since"""
+
+        with self.lock:
+            ts.extend(self.ts)
+            states.extend(self.states)
+            self.ts, self.states = ts, states
+
+    def to_log_rows(self, ts: array.array, states: array.array) -> list[db.LogRow]:
+        rows = []
+        for ts_us, state in zip(ts, states):
+            row_ts = epoch + datetime.timedelta(microseconds=ts_us)
+            rows.append(db.LogRow(self.label, State(state).name, row_ts.date(), row_ts))
+        return rows
+
+
+class WriteBehind:
+    """
+    Background thread which writes log events from each label's EventBuffer in batches every
+    interval, and the latest state snapshot (earlier snapshots which haven't been written yet
+    are dropped). At most max_pending log events wait to be written, any more are dropped.
+    The write-ahead log is checkpointed every checkpoint_interval and on close
+    """
+
+    def __init__(self, conn_str: str = db.default_db_url, interval: float = default_interval, max_pending: int = default_max_pending) -> None:
+        self.conn_str = conn_str
+        self.interval = interval
+        self.buffers: dict[str, EventBuffer] = {}
+        # taken by each append and given back once the event is written
+        self.room = threading.Semaphore(max_pending)
+        # latest state snapshot not yet written
+        self.state: list[dict[str, Any]] | None = None
+        self.state_lock = threading.Lock()
+        # only one flush at a time, the thread's or close()'s
+        self.flush_lock = threading.Lock()
+        self.wake = threading.Event()
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="write-behind", daemon=True)
+
+        self.last_checkpoint = time.monotonic()
+
+        self.n_written = 0
+        self.last_error: Exception | None = None
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def events(self, label: str) -> EventBuffer:
+        """The buffer for label's log events, which the writer drains"""
+
+        if label not in self.buffers:
+            self.buffers[label] = EventBuffer(label, self.room)
+        return self.buffers[label]
+
+    def write_state(self, rows: list[dict[str, Any]]) -> None:
+        """Queue a state snapshot to replace what is in the db"""
+
+        with self.state_lock:
+            self.state = rows
+
+    def pending(self) -> int:
+        """Log rows not yet written"""
+
+        return sum(map(len, list(self.buffers.values())))
+
+    def dropped(self) -> int:
+        """Log events dropped as max_pending were already waiting to be written"""
+
+        return sum(buffer.n_dropped for buffer in list(self.buffers.values()))
+
+    def run(self) -> None:
+        while not self.stopping.is_set():
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            self.flush()
+            if time.monotonic() - self.last_checkpoint >= checkpoint_interval:
+                self.checkpoint()
+
+    def flush(self) -> None:
+        """Write everything queued so far, keeping hold of anything which fails to be retried"""
+
+        with self.flush_lock:
+            try:
+                self.flush_log()
+                self.flush_state()
+                self.last_error = None
+            except Exception as e:
+                self.last_error = e
+
+    def flush_log(self) -> None:
+        rows = []
+        # list() as the app can add buffers meanwhile
+        for buffer in list(self.buffers.values()):
+            if len(buffer):
+                rows += buffer.to_log_rows(*buffer.drain())
+
+        # In ts order so each label's start comes before its stop across batches
+        rows.sort(key=lambda row: row.ts)
+        written = 0
+        try:
+            while written < len(rows):
+                batch = rows[written : written + max_batch]
+                db.write_log_rows(batch, conn_str=self.conn_str)
+                written += len(batch)
+                self.n_written += len(batch)
+                self.room.release(len(batch))
+        finally:
+            if written < len(rows):
+                self.put_back(rows[written:])
+
+    def put_back(self, rows: list[db.LogRow]) -> None:
+        """Returns rows which failed to be written to their buffers, to be retried next flush"""
+
+        unwritten: dict[str, tuple[array.array, array.array]] = {}
+        for row in rows:
+            ts, states = unwritten.setdefault(row.label, (array.array("q"), array.array("b")))
+            ts.append(epoch_us(row.ts))
+            states.append(State[row.state])
+        for label, (ts, states) in unwritten.items():
+            self.buffers[label].put_back(ts, states)
+
+    def flush_state(self) -> None:
+        with self.state_lock:
+            state, self.state = self.state, None
+
+        if state is None:
+            return
+
+        try:
+            db.replace_state(state, conn_str=self.conn_str)
+        except Exception:
+            # Put it back unless a newer snapshot has arrived meanwhile
+            with self.state_lock:
+                if self.state is None:
+                    self.state = state
+            raise
+
+    def checkpoint(self, mode: str = "PASSIVE") -> None:
+        with self.flush_lock:
+            try:
+                db.checkpoint(mode, conn_str=self.conn_str)
+            except Exception as e:
+                self.last_error = e
+        self.last_checkpoint = time.monotonic()
+
+    def close(self) -> None:
+        """Stop the thread, write anything still queued and empty the write-ahead log, call on exit"""
+
+        self.stopping.set()
+        self.wake.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        self.flush()
+        self.checkpoint("TRUNCATE")
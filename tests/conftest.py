@@ -0,0 +1,47 @@
+import datetime
+import os
+
+import db
+import pytest
+
+from typing import Final, Iterable
+
+t0: Final[datetime.datetime] = datetime.datetime(2023, 7, 1, tzinfo=datetime.timezone.utc)
+
+
+def log_rows(
+    events: int | Iterable[tuple[str, str, float]],
+    start: datetime.datetime = t0,
+    step: datetime.timedelta = datetime.timedelta(minutes=1),
+    label: str = "label",
+) -> list[db.LogRow]:
+    """
+    Log rows for (label, state, steps after start) events, or for that many events of label
+    being started and stopped in turn a step apart
+    """
+
+    if isinstance(events, int):
+        events = [(label, "start" if i % 2 == 0 else "stop", i) for i in range(events)]
+    return [db.LogRow(label, state, (start + step * n).date(), start + step * n) for label, state, n in events]
+
+
+@pytest.fixture
+def conn_str(tmp_path) -> str:
+    return f"sqlite:///{tmp_path}/test.sqlite3"
+
+
+@pytest.fixture
+def remote_conn_str(tmp_path) -> str:
+    """The other side of a sync"""
+
+    return f"sqlite:///{tmp_path}/remote.sqlite3"
+
+
+@pytest.fixture
+def postgres_conn_str() -> str:
+    """A Postgres db to test against, skipped unless PUNCH_CARD_TEST_POSTGRES is set to its URL"""
+
+    conn_str = os.environ.get("PUNCH_CARD_TEST_POSTGRES")
+    if not conn_str:
+        pytest.skip("PUNCH_CARD_TEST_POSTGRES is not set")
+    return conn_str
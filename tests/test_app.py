@@ -0,0 +1,147 @@
+import asyncio
+
+import app as app_module
+import db
+from app import Punchcard, TimeDisplay, Timer, ActivityList, add_timer, add_timers
+from writer import WriteBehind
+
+
+def run_app(test, conn_str: str, **writer_options) -> None:
+    """Runs test(app, pilot) against a headless app writing to conn_str"""
+
+    async def run() -> None:
+        app_module.app = Punchcard(writer=WriteBehind(conn_str=conn_str, **writer_options))
+        async with app_module.app.run_test() as pilot:
+            await test(app_module.app, pilot)
+        app_module.app.writer.close()
+
+    asyncio.run(run())
+
+
+def test_shared_ticker(conn_str):
+    async def test(app, pilot):
+        add_timer("a")
+        add_timer("b")
+        await pilot.pause()
+        assert app.ticker is None
+
+        a, b = app.query(Timer)
+        a.query_one("#start").press()
+        await pilot.pause()
+        assert app.running == {a.query_one(TimeDisplay)}
+        assert app.ticker is not None
+
+        b.query_one("#start").press()
+        await pilot.pause()
+        assert len(app.running) == 2
+
+        a.query_one("#stop").press()
+        b.query_one("#stop").press()
+        await pilot.pause()
+        # Nothing running, so nothing ticking
+        assert app.running == set()
+        assert app.ticker is None
+
+    run_app(test, conn_str)
+    assert [row.state for row in db.read_timer_log(conn_str=conn_str) if row.label == "a"] == ["start", "stop"]
+
+
+def test_time_display_only_renders_on_change(monkeypatch, conn_str):
+    async def test(app, pilot):
+        add_timer("a")
+        await pilot.pause()
+        time_display = app.query_one(TimeDisplay)
+
+        rendered = []
+        monkeypatch.setattr(time_display, "update", rendered.append)
+        for time in [1.1, 1.5, 1.9, 2.0, 2.2]:
+            time_display.time = time
+        assert rendered == ["00:00:01", "00:00:02"]
+
+    run_app(test, conn_str)
+
+
+def test_restore_timers(monkeypatch, conn_str):
+    saved = [db.TimerStateBase(label=f"activity {i}", elapsed=float(i), ts=None) for i in range(500)]
+    monkeypatch.setattr(db, "read_state", lambda: saved)
+
+    async def test(app, pilot):
+        app.action_read_from_db()
+        await pilot.pause()
+        assert len(app.activities) == 500
+        # Only rows for what fits are created
+        assert 0 < len(app.query(Timer)) < 10
+
+        # Duplicates are skipped
+        add_timers([("activity 0", 0.0), ("new", 0.0)])
+        await pilot.pause()
+        assert list(app.activities)[-2:] == ["activity 499", "new"]
+        # and the list scrolled to what was added
+        assert app.query(Timer).last().label == "new"
+
+        app.action_remove_timer()
+        await pilot.pause()
+        assert "new" not in app.activities
+        assert app.query(Timer).last().label == "activity 499"
+
+    run_app(test, conn_str)
+
+
+def test_activities_off_screen_keep_running(conn_str):
+    async def test(app, pilot):
+        add_timers([(f"activity {i}", 0.0) for i in range(50)])
+        await pilot.pause()
+        activity_list = app.query_one(ActivityList)
+
+        activity_list.action_scroll_rows(-100)
+        await pilot.pause()
+        first = app.query(Timer).first()
+        assert first.label == "activity 0"
+        first.query_one("#start").press()
+        await pilot.pause()
+
+        # Scrolled out of view the row is reused, but the activity still runs
+        activity_list.action_scroll_page(1)
+        await pilot.pause()
+        assert first.label != "activity 0"
+        assert app.activities["activity 0"].running
+        assert not first.has_class("started")
+        assert app.running == set()
+
+        activity_list.action_scroll_rows(-100)
+        await pilot.pause()
+        assert first.has_class("started")
+        assert app.running == {first.query_one(TimeDisplay)}
+
+    run_app(test, conn_str)
+
+
+def test_write_to_db_goes_through_writer(conn_str):
+    async def test(app, pilot):
+        add_timer("a")
+        await pilot.pause()
+        app.query_one("#start").press()
+        await pilot.pause()
+
+        app.action_write_to_db()
+        await pilot.pause()
+        assert not app.activities["a"].running
+
+    run_app(test, conn_str)
+    assert [row.state for row in db.read_timer_log(conn_str=conn_str)] == ["start"]
+    assert [(row.label, row.elapsed) for row in db.read_state(conn_str=conn_str)] == [("a", 0.0)]
+
+
+def test_actions_dropped_when_writer_is_full(conn_str):
+    async def test(app, pilot):
+        add_timer("a")
+        await pilot.pause()
+        app.query_one("#start").press()
+        await pilot.pause()
+
+        # The timer still runs, it just isn't logged
+        assert app.activities["a"].running
+        assert app.sub_title.startswith("timer started, but not logged")
+        assert app.writer.dropped() == 1
+
+    run_app(test, conn_str, max_pending=0)
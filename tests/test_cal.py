@@ -0,0 +1,32 @@
+import datetime
+
+import db
+from icalendar import Calendar
+
+from cal import cal, parse_date_range
+from conftest import log_rows, t0
+
+
+def test_parse_date_range():
+    assert parse_date_range("2023-07-01") == (datetime.date(2023, 7, 1), datetime.date(2023, 7, 1))
+    assert parse_date_range("2023-07-01..2023-09-30") == (datetime.date(2023, 7, 1), datetime.date(2023, 9, 30))
+
+
+def test_cal(tmp_path, conn_str, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    # Two timers at the same time each day, the second of which runs past midnight
+    day = 24 * 60
+    events = [("a", "start", 0), ("b", "start", 5), ("a", "stop", 30), ("b", "stop", 150)]
+    rows = log_rows([(label, state, i * day + minutes) for i in range(4) for label, state, minutes in events], start=t0 + datetime.timedelta(hours=22))
+    db.write_log_rows(rows, conn_str=conn_str)
+
+    path = cal(datetime.date(2023, 7, 2), datetime.date(2023, 7, 3), conn_str=conn_str)
+    events = Calendar.from_ical(path.read_bytes()).walk("VEVENT")
+    assert [(str(e["summary"]), e.decoded("dtstart"), e.decoded("dtend")) for e in events] == [
+        (r.label, r.ts, s.ts) for r, s in [(rows[4], rows[6]), (rows[5], rows[7]), (rows[8], rows[10]), (rows[9], rows[11])]
+    ]
+    assert len({e["uid"] for e in events}) == 4
+
+    assert cal(datetime.date(2024, 1, 1), conn_str=conn_str) is None
+    # No empty calendar is left behind
+    assert [p.name for p in tmp_path.glob("*.ics")] == [path.name]
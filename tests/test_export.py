@@ -0,0 +1,57 @@
+import datetime
+
+import db
+import pyarrow.dataset
+import pyarrow.parquet as pq
+
+from conftest import log_rows
+from export import export
+
+
+def days_of_log_rows(start: datetime.datetime, days: int) -> list[db.LogRow]:
+    """Each day a and b run at the same time, b for longer"""
+
+    return log_rows(
+        [(label, state, day * 24 * 60 + minutes) for day in range(days) for label, state, minutes in [("a", "start", 0), ("b", "start", 10), ("a", "stop", 30), ("b", "stop", 60)]], start=start
+    )
+
+
+def test_export(tmp_path, conn_str):
+    out_dir = tmp_path / "export"
+    # The last session of July finishes in August
+    db.write_log_rows(days_of_log_rows(datetime.datetime(2023, 6, 20, 23, 30, tzinfo=datetime.timezone.utc), 42), conn_str=conn_str)
+
+    assert export(out_dir, conn_str=conn_str) == (42 * 4, 42 * 2)
+    june = pq.read_table(out_dir / "timer_log", filters=[("year", "=", 2023), ("month", "=", 6)])
+    assert len(june) == 11 * 4 - 2
+    july = pyarrow.dataset.dataset(out_dir / "sessions", partitioning="hive").to_table(filter=pyarrow.dataset.field("month") == 7)
+    assert len(july) == 31 * 2
+    assert set(july.column("elapsed").to_pylist()) == {1800.0, 3000.0}
+
+    # Later runs only write the latest month (August, which has the stops of 31 July) again and anything after it
+    june_file = next((out_dir / "timer_log" / "year=2023" / "month=6").iterdir())
+    june_mtime = june_file.stat().st_mtime_ns
+    db.write_log_rows(days_of_log_rows(datetime.datetime(2023, 8, 1, 12, tzinfo=datetime.timezone.utc), 40), conn_str=conn_str)
+    assert export(out_dir, conn_str=conn_str) == (2 + 40 * 4, 40 * 2)
+    assert june_file.stat().st_mtime_ns == june_mtime
+
+    log = pq.read_table(out_dir / "timer_log")
+    assert len(log) == 82 * 4
+    assert log.column("ts").to_pylist()[-1] == datetime.datetime(2023, 9, 9, 13, tzinfo=datetime.timezone.utc)
+
+
+def test_export_carries_over_running_starts(tmp_path, conn_str):
+    out_dir = tmp_path / "export"
+    start = datetime.datetime(2024, 1, 31, 23, tzinfo=datetime.timezone.utc)
+    db.write_log_rows(log_rows([("a", "start", 0), ("b", "start", 70), ("b", "stop", 80)], start=start), conn_str=conn_str)
+    assert export(out_dir, conn_str=conn_str) == (3, 1)
+
+    # a's stop comes after its start's month has been exported, and the next run only reads from February
+    db.write_log_rows(log_rows([("a", "stop", 180)], start=start), conn_str=conn_str)
+    assert export(out_dir, conn_str=conn_str) == (3, 2)
+    sessions = pq.read_table(out_dir / "sessions")
+    assert sorted(zip(sessions.column("label").to_pylist(), sessions.column("elapsed").to_pylist())) == [("a", 10800.0), ("b", 600.0)]
+
+    # and it is only written the once
+    assert export(out_dir, conn_str=conn_str) == (3, 1)
+    assert len(pq.read_table(out_dir / "sessions")) == 2
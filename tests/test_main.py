@@ -0,0 +1,26 @@
+import pathlib
+import subprocess
+import sys
+
+src = str(pathlib.Path(__file__).resolve().parent.parent / "src")
+
+# Only the subsystem for the flag that was used should be imported
+heavy_modules = ["textual", "pandas", "sqlalchemy", "icalendar", "psycopg2", "app", "cal", "sync", "db", "rebuild_state_from_log", "pairing", "numpy", "report", "export", "pyarrow"]
+
+
+def imported_after(code: str) -> set[str]:
+    check = f"import sys; sys.path.insert(0, {src!r}); {code}; print(','.join(sys.modules))"
+    stdout = subprocess.run([sys.executable, "-c", check], check=True, capture_output=True, text=True).stdout
+    return set(stdout.strip().split(","))
+
+
+def test_main_imports_nothing_heavy():
+    assert imported_after("import main").isdisjoint(heavy_modules)
+
+
+def test_sync_does_not_import_app_or_pandas():
+    assert imported_after("import main, sync").isdisjoint(["textual", "pandas", "app", "cal"])
+
+
+def test_cal_does_not_import_pandas_until_used():
+    assert "pandas" not in imported_after("import main, cal")
@@ -0,0 +1,49 @@
+import datetime
+
+import db
+import metrics
+import pytest
+from conftest import log_rows, t0
+from sync import sync_log
+
+
+@pytest.fixture
+def enabled():
+    metrics.reset()
+    metrics.enable()
+    yield
+    metrics.disable()
+    metrics.reset()
+
+
+def test_nothing_recorded_unless_enabled(conn_str):
+    metrics.reset()
+    db.write_log_rows(log_rows(4), conn_str=conn_str)
+    assert list(db.iter_timer_log(conn_str=conn_str)) != []
+    assert metrics.to_dict() == {}
+
+
+def test_functions_and_statements(conn_str, enabled):
+    db.write_log_rows(log_rows(4), conn_str=conn_str)
+    chunks = list(db.iter_timer_log(chunk_size=3, conn_str=conn_str))
+
+    stats = metrics.to_dict()
+    assert stats["function"]["write_log_rows"]["calls"] == 1
+    assert stats["function"]["write_log_rows"]["rows"] == 4
+    # Generators count the rows in what they yield
+    assert [len(chunk) for chunk in chunks] == [3, 1]
+    assert stats["function"]["iter_timer_log"]["rows"] == 4
+    assert stats["statement"]["INSERT timer_log"]["calls"] >= 1
+    assert stats["statement"]["SELECT timer_log"]["calls"] >= 2
+    assert sum(stats["statement"]["SELECT timer_log"]["histogram_ms"].values()) == stats["statement"]["SELECT timer_log"]["calls"]
+    assert "write_log_rows" in metrics.summary()
+
+
+def test_sync_phases(conn_str, remote_conn_str, enabled):
+    db.write_log_rows(log_rows(4), conn_str=conn_str)
+    db.write_log_rows(log_rows(2, start=t0 + datetime.timedelta(hours=1)), conn_str=remote_conn_str)
+
+    assert sync_log(conn_str, remote_conn_str) == (4, 2)
+    phases = metrics.to_dict()["phase"]
+    assert phases.keys() == {"sync_log.read_vectors", "sync_log.count", "sync_log.diff", "sync_log.copy"}
+    assert phases["sync_log.count"]["rows"] == phases["sync_log.copy"]["rows"] == 6
@@ -0,0 +1,31 @@
+import pandas as pd
+
+from conftest import log_rows
+from pairing import StreamingPairer, events_frame, pair_events
+
+# Two timers running at the same time, a start which was never stopped and one still running
+interleaved = events_frame(log_rows([("a", "start", 0), ("b", "start", 1), ("a", "stop", 2), ("c", "start", 3), ("b", "stop", 5), ("c", "start", 6), ("c", "stop", 7), ("a", "start", 8)]))
+
+
+def test_pair_events():
+    sessions, orphans, running = pair_events(interleaved)
+    assert list(sessions.itertuples(index=False, name=None))[0][:3] == ("a", interleaved.ts[0], interleaved.ts[2])
+    assert [(r.label, r.elapsed) for r in sessions.itertuples()] == [("a", 120.0), ("b", 240.0), ("c", 60.0)]
+    assert [(r.label, r.ts) for r in orphans.itertuples()] == [("c", interleaved.ts[3])]
+    assert [(r.label, r.ts) for r in running.itertuples()] == [("a", interleaved.ts[7])]
+
+
+def test_streaming_pairer_matches_pair_events():
+    sessions, orphans, running = pair_events(interleaved)
+
+    for chunk_size in range(1, len(interleaved) + 1):
+        pairer = StreamingPairer()
+        fed = [pairer.feed(interleaved.iloc[i : i + chunk_size]) for i in range(0, len(interleaved), chunk_size)]
+        assert sorted(pd.concat([s for s, _ in fed]).itertuples(index=False, name=None)) == sorted(sessions.itertuples(index=False, name=None))
+        assert sorted(pd.concat([o for _, o in fed]).itertuples(index=False, name=None)) == sorted(orphans.itertuples(index=False, name=None))
+        assert pairer.running.equals(running)
+
+
+def test_events_frame():
+    frame = events_frame(interleaved.itertuples())
+    assert frame.equals(interleaved)
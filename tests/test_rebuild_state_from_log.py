@@ -0,0 +1,32 @@
+import db
+import rebuild_state_from_log
+from conftest import log_rows
+from rebuild_state_from_log import rebuild
+
+
+def read_state(conn_str: str) -> dict[str, float]:
+    return {row.label: row.elapsed for row in db.read_state(conn_str=conn_str)}
+
+
+def test_rebuild(conn_str, monkeypatch):
+    # Small chunks so the log is streamed over several queries
+    monkeypatch.setattr(rebuild_state_from_log, "chunk_size", 2)
+
+    # Two timers running at the same time, and one which is deleted
+    db.write_log_rows(
+        log_rows([("a", "start", 0), ("b", "start", 1), ("a", "stop", 10), ("c", "start", 11), ("c", "stop", 12), ("c", "delete", 13)]),
+        conn_str=conn_str,
+    )
+    assert rebuild(conn_str=conn_str) == {"a": 600.0, "b": 0.0}
+    assert read_state(conn_str) == {"a": 600.0, "b": 0.0}
+
+    # b was running at the checkpoint and is stopped afterwards
+    db.write_log_rows(log_rows([("b", "stop", 31), ("a", "start", 40), ("a", "stop", 50)]), conn_str=conn_str)
+    assert db.read_rebuild_checkpoint(conn_str=conn_str)[1] == 6
+    assert rebuild(conn_str=conn_str) == {"a": 1200.0, "b": 1800.0}
+    assert rebuild(full=True, conn_str=conn_str) == {"a": 1200.0, "b": 1800.0}
+
+    # A row from before the checkpoint (e.g. from a sync) means going through the whole log again
+    db.write_log_rows(log_rows([("b", "start", 30)]), conn_str=conn_str)
+    assert rebuild(conn_str=conn_str) == {"a": 1200.0, "b": 60.0}
+    assert read_state(conn_str) == {"a": 1200.0, "b": 60.0}
@@ -0,0 +1,36 @@
+import datetime
+import io
+import json
+
+import db
+from conftest import log_rows
+from report import write_report
+
+
+def test_read_period_totals(conn_str):
+    rows = []
+    # Sunday 2 July, Monday 3 July and Tuesday 1 August 2023
+    for month, day, hour, label, minutes in [(7, 2, 9, "a", 60), (7, 3, 9, "a", 30), (7, 3, 12, "b", 90), (8, 1, 9, "a", 15)]:
+        start = datetime.datetime(2023, month, day, hour, tzinfo=datetime.timezone.utc)
+        rows += log_rows([(label, "start", 0), (label, "stop", minutes)], start=start)
+    db.write_log_rows(rows, conn_str=conn_str)
+
+    weeks = db.read_period_totals("week", conn_str=conn_str)
+    assert [(r.period, r.label, r.seconds, r.sessions, r.rank, r.running_seconds) for r in weeks] == [
+        (datetime.date(2023, 6, 26), "a", 3600.0, 1, 1, 3600.0),
+        (datetime.date(2023, 7, 3), "b", 5400.0, 1, 1, 5400.0),
+        (datetime.date(2023, 7, 3), "a", 1800.0, 1, 2, 5400.0),
+        (datetime.date(2023, 7, 31), "a", 900.0, 1, 1, 6300.0),
+    ]
+    assert [r.share for r in weeks] == [1.0, 0.75, 0.25, 1.0]
+
+    months = db.read_period_totals("month", since=datetime.date(2023, 7, 3), conn_str=conn_str)
+    assert [(r.period, r.label, r.seconds) for r in months] == [(datetime.date(2023, 7, 1), "b", 5400.0), (datetime.date(2023, 7, 1), "a", 1800.0), (datetime.date(2023, 8, 1), "a", 900.0)]
+
+    out = io.StringIO()
+    write_report(months, fmt="json", out=out)
+    assert json.loads(out.getvalue())[0] == dict(period="2023-07-01", label="b", seconds=5400.0, sessions=1, share=0.75, rank=1, running_seconds=5400.0)
+
+    out = io.StringIO()
+    write_report(months, fmt="csv", out=out)
+    assert out.getvalue().splitlines()[:2] == ["period,label,seconds,sessions,share,rank,running_seconds", "2023-07-01,b,5400.0,1,0.75,1,5400.0"]
@@ -1,4 +1,11 @@
+import contextlib
+import pathlib
+import sqlite3
+import threading
+import sync as sync_module
 from sync import *
+from typing import Iterator
+from conftest import log_rows, t0
 from icecream import ic
 
 
@@ -10,3 +17,164 @@ def test_load_config():
 
 def test_get_most_recent_state_timestamps():
     get_most_recent_state_timestamps(*get_local_remote_conn_str())
+
+
+# how SQLAlchemy stores datetimes in SQLite
+sqlite_ts_format: Final[str] = "%Y-%m-%d %H:%M:%S.%f"
+
+
+def sync_log_rows(local_conn_str: str, remote_conn_str: str) -> tuple[list[db.LogRow], list[db.LogRow]]:
+    """(rows sent to remote, rows sent to local) by sync_log"""
+
+    sent = {to_remote_symbol: [], to_local_symbol: []}
+    n_to_remote, n_to_local = sync_log(local_conn_str, remote_conn_str, report=lambda symbol, row: sent[symbol].append(row))
+    assert (n_to_remote, n_to_local) == (len(sent[to_remote_symbol]), len(sent[to_local_symbol]))
+    return sent[to_remote_symbol], sent[to_local_symbol]
+
+
+def test_sync_log(conn_str, remote_conn_str):
+    db.write_log_rows(log_rows(4, label="local"), conn_str=conn_str)
+    db.write_log_rows(log_rows(6, start=t0 + datetime.timedelta(hours=1), label="remote"), conn_str=remote_conn_str)
+
+    to_remote, to_local = sync_log_rows(conn_str, remote_conn_str)
+    assert (len(to_remote), len(to_local)) == (4, 6)
+    assert db.read_timer_log_vector(conn_str=conn_str) == db.read_timer_log_vector(conn_str=remote_conn_str)
+    assert len(db.read_timer_log(conn_str=conn_str)) == len(db.read_timer_log(conn_str=remote_conn_str)) == 10
+
+    # Only the new rows go across
+    db.write_log_rows(log_rows(2, start=t0 + datetime.timedelta(hours=2), label="local"), conn_str=conn_str)
+    to_remote, to_local = sync_log_rows(conn_str, remote_conn_str)
+    assert [row.seq for row in to_remote] == [5, 6]
+    assert to_local == []
+
+    # Nothing to do
+    assert sync_log_rows(conn_str, remote_conn_str) == ([], [])
+
+
+def legacy_db(path: pathlib.Path, rows: list[db.LogRow]) -> str:
+    """A database from before devices were tracked"""
+
+    with sqlite3.connect(path) as conn:
+        conn.execute("CREATE TABLE timer_log (label TEXT NOT NULL, state TEXT NOT NULL, date DATE NOT NULL, ts DATETIME NOT NULL, PRIMARY KEY (ts))")
+        conn.executemany("INSERT INTO timer_log VALUES (?, ?, ?, ?)", [(row.label, row.state, str(row.date), row.ts.strftime(sqlite_ts_format)) for row in rows])
+    return f"sqlite:///{path}"
+
+
+def test_sync_log_legacy_rows(tmp_path):
+    # SQLite hands back naive datetimes
+    rows = log_rows(6, start=t0.replace(tzinfo=None), label="legacy")
+
+    # Sharing some of their history
+    conn_strs = [legacy_db(tmp_path / "local.sqlite3", rows[:4]), legacy_db(tmp_path / "remote.sqlite3", rows[2:])]
+    to_remote, to_local = sync_log_rows(*conn_strs)
+    assert [row.ts for row in to_remote] == [row.ts for row in rows[:2]]
+    assert [row.ts for row in to_local] == [row.ts for row in rows[4:]]
+    assert db.read_timer_log_vector(conn_str=conn_strs[0]) == db.read_timer_log_vector(conn_str=conn_strs[1])
+    assert sync_log_rows(*conn_strs) == ([], [])
+
+    # The same number of rows and the same latest one, but not the same rows: legacy seqs (epoch
+    # microseconds) have gaps, so only the vectors' checksums tell them apart
+    y, w = log_rows([("y", "start", 2.25), ("w", "start", 2.5)], start=t0.replace(tzinfo=None))
+    conn_strs = [legacy_db(tmp_path / "y.sqlite3", rows[:2] + [y] + rows[3:]), legacy_db(tmp_path / "w.sqlite3", rows[:2] + [w] + rows[3:])]
+    vectors = [db.read_timer_log_vector(conn_str=conn_str) for conn_str in conn_strs]
+    assert vectors[0]["legacy"][:2] == vectors[1]["legacy"][:2] and vectors[0] != vectors[1]
+    to_remote, to_local = sync_log_rows(*conn_strs)
+    assert ([row.label for row in to_remote], [row.label for row in to_local]) == (["y"], ["w"])
+    assert db.read_timer_log_vector(conn_str=conn_strs[0]) == db.read_timer_log_vector(conn_str=conn_strs[1])
+
+
+def test_sync(conn_str, remote_conn_str, capsys):
+    db.write_log_rows(log_rows(4, label="local"), conn_str=conn_str)
+    db.write_log_rows(log_rows(2, start=t0 + datetime.timedelta(hours=1), label="remote"), conn_str=remote_conn_str)
+    db.write_state(dict(label="local", elapsed=2 * 60.0, ts=t0 + datetime.timedelta(hours=2)), conn_str=conn_str)
+
+    sync(conn_str, remote_conn_str)
+    out = capsys.readouterr().out
+    assert "Synced 4 rows to remote, 2 rows to local in" in out
+    # Rows are only printed when verbose
+    assert f"{to_remote_symbol} LogRow" not in out
+    assert [row.label for row in db.read_state(conn_str=remote_conn_str)] == ["local"]
+    assert len(db.read_timer_log(conn_str=remote_conn_str)) == 6
+
+    db.write_log_rows(log_rows(2, start=t0 + datetime.timedelta(hours=3), label="local"), conn_str=conn_str)
+    sync(conn_str, remote_conn_str, verbose=True)
+    assert capsys.readouterr().out.count(f"{to_remote_symbol} LogRow") == 2
+
+
+def test_diff_device_only_reads_dates_which_differ(conn_str, remote_conn_str, monkeypatch):
+    # spread over ten days
+    rows = [row._replace(device="device", seq=i + 1) for i, row in enumerate(log_rows(10, step=datetime.timedelta(days=1)))]
+
+    db.write_log_rows(rows, conn_str=conn_str)
+    db.write_log_rows(rows[:3] + rows[4:], conn_str=remote_conn_str)
+
+    read_dates = []
+    read_timer_log_dates = db.read_timer_log_dates
+    monkeypatch.setattr(db, "read_timer_log_dates", lambda dates, *args, **kwargs: read_dates.append(dates) or read_timer_log_dates(dates, *args, **kwargs))
+
+    to_remote, to_local = diff_device("device", conn_str, remote_conn_str)
+    assert [row.seq for row in to_remote] == [4]
+    assert to_local == []
+    assert read_dates == [[rows[3].date]] * 2
+
+
+def wait_for(condition: Callable[[], bool], timeout: float = 10.0) -> None:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+@contextlib.contextmanager
+def running_daemon(local_conn_str: str, remote_conn_str: str, **kwargs: Any) -> Iterator[concurrent.futures.Future]:
+    """sync_daemon on a thread of its own, stopped on leaving even if the test fails"""
+
+    stop = threading.Event()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as pool:
+        future = pool.submit(sync_daemon, local_conn_str, remote_conn_str, stop=stop, poll_interval=0.02, coalesce=0.02, **kwargs)
+        try:
+            yield future
+        finally:
+            stop.set()
+
+
+def test_sync_daemon(conn_str, remote_conn_str, monkeypatch):
+    db.write_log_rows(log_rows(2, label="remote"), conn_str=remote_conn_str)
+
+    syncs = []
+    monkeypatch.setattr(sync_module, "sync_log", lambda *args: syncs.append(args) or sync_log(*args))
+    with running_daemon(conn_str, remote_conn_str, pull_interval=60) as future:
+        # Pulls on starting, then pushes what is written
+        wait_for(lambda: len(db.read_timer_log(conn_str=conn_str)) == 2)
+        db.write_log_rows(log_rows(4, start=t0 + datetime.timedelta(hours=1), label="local"), conn_str=conn_str)
+        wait_for(lambda: len(db.read_timer_log(conn_str=remote_conn_str)) == 6)
+
+        # Idle, the remote is left alone
+        wait_for(lambda: db.read_timer_log_vector(conn_str=conn_str) == db.read_timer_log_vector(conn_str=remote_conn_str))
+        time.sleep(0.2)
+        n_syncs = len(syncs)
+        time.sleep(0.2)
+        assert len(syncs) == n_syncs
+
+    assert future.result(timeout=10) == (4, 2)
+
+
+def test_sync_daemon_backs_off(tmp_path, conn_str, capsys):
+    # Can't be opened until its directory exists
+    remote_dir = tmp_path / "remote"
+    remote_conn_str = f"sqlite:///{remote_dir}/remote.sqlite3"
+    db.write_log_rows(log_rows(2, label="local"), conn_str=conn_str)
+
+    assert [backoff(failures, 2.0, 10.0) for failures in range(1, 6)] == [2.0, 4.0, 8.0, 10.0, 10.0]
+
+    with running_daemon(conn_str, remote_conn_str, max_backoff=0.1) as future:
+        # 0.02s, 0.04s, 0.08s then the most it waits
+        out = []
+        wait_for(lambda: out.append(capsys.readouterr().out) or "Sync failed (OperationalError), trying again in 0.1s" in "".join(out))
+
+        # Once the remote is back the rows go across, opening it here meanwhile could race the daemon creating its tables
+        remote_dir.mkdir()
+        wait_for(lambda: out.append(capsys.readouterr().out) or "Synced 2 rows to remote" in "".join(out))
+
+    assert future.result(timeout=10) == (2, 0)
+    assert len(db.read_timer_log(conn_str=remote_conn_str)) == 2
@@ -0,0 +1,99 @@
+import datetime
+
+import db
+import writer as writer_module
+from common import epoch_us
+from conftest import log_rows, t0
+from writer import State, WriteBehind
+
+step = datetime.timedelta(seconds=1)
+
+
+def append(writer: WriteBehind, rows: list[db.LogRow]) -> None:
+    """Log rows the way the app's activities do"""
+
+    for row in rows:
+        writer.events(row.label).append(State[row.state], epoch_us(row.ts))
+
+
+def test_flushes_on_close(tmp_path, conn_str):
+    # Long interval, so only close() writes
+    writer = WriteBehind(conn_str=conn_str, interval=60)
+    writer.start()
+
+    append(writer, log_rows(10, step=step))
+    writer.write_state([dict(label="label", elapsed=1.0, ts=t0)])
+    writer.write_state([dict(label="label", elapsed=2.0, ts=t0)])
+    assert writer.pending() == 10
+
+    writer.close()
+    assert writer.pending() == 0
+    assert writer.n_written == 10
+    # The write-ahead log has been checkpointed into the db
+    assert (tmp_path / "test.sqlite3-wal").stat().st_size == 0
+    assert len(db.read_timer_log(conn_str=conn_str)) == 10
+    # Only the latest state is written
+    assert [row.elapsed for row in db.read_state(conn_str=conn_str)] == [2.0]
+
+
+def test_retries_after_failure(conn_str, monkeypatch):
+    a, b = log_rows(6, step=step, label="a"), log_rows(6, start=t0 + step / 2, step=step, label="b")
+    writer = WriteBehind(conn_str=conn_str)
+    append(writer, a[:4] + b[:4])
+
+    # The first batch (a0 b0 a1 b1 a2) is written, the second fails
+    monkeypatch.setattr(writer_module, "max_batch", 5)
+    write_log_rows = db.write_log_rows
+    batches = []
+
+    def fail_after_first_batch(rows, **kwargs):
+        batches.append(rows)
+        return write_log_rows(rows, **kwargs) if len(batches) == 1 else 1 / 0
+
+    monkeypatch.setattr(db, "write_log_rows", fail_after_first_batch)
+    writer.flush()
+    assert isinstance(writer.last_error, ZeroDivisionError)
+    assert (writer.n_written, writer.pending()) == (5, 3)
+
+    # What wasn't written is back in the buffers, as arrays, ahead of anything appended since
+    append(writer, a[4:] + b[4:])
+    buffers = writer.events("a"), writer.events("b")
+    assert [(buffer.ts.typecode, buffer.states.typecode) for buffer in buffers] == [("q", "b"), ("q", "b")]
+    assert [buffer.to_log_rows(buffer.ts, buffer.states) for buffer in buffers] == [a[3:], b[2:]]
+
+    monkeypatch.setattr(db, "write_log_rows", write_log_rows)
+    writer.flush()
+    assert writer.last_error is None
+    assert writer.pending() == 0
+    # sqlite drops the tz
+    assert [(row.label, row.state, row.ts) for row in db.read_timer_log(conn_str=conn_str)] == [(row.label, row.state, row.ts.replace(tzinfo=None)) for row in sorted(a + b, key=lambda row: row.ts)]
+
+
+def test_max_pending(conn_str):
+    rows = log_rows(3, step=step)
+    writer = WriteBehind(conn_str=conn_str, max_pending=2)
+    append(writer, rows[:2])
+
+    # Dropped rather than waited on
+    assert not writer.events("label").append(State.start, epoch_us(rows[2].ts))
+    assert (writer.pending(), writer.dropped()) == (2, 1)
+
+    # Writing them makes room again
+    writer.flush()
+    append(writer, rows[2:])
+    assert (writer.pending(), writer.dropped()) == (1, 1)
+
+
+def test_event_buffer():
+    writer = WriteBehind()
+    buffer = writer.events("label")
+    assert writer.events("label") is buffer
+
+    rows = log_rows(3, step=step)
+    append(writer, rows)
+    assert writer.pending() == 3
+
+    ts_us, states = buffer.drain()
+    assert (ts_us.itemsize, states.itemsize) == (8, 1)
+    assert len(buffer) == 0 and writer.pending() == 0
+    assert buffer.to_log_rows(ts_us, states) == rows